@@ -1,52 +1,271 @@
+import asyncio
+import contextvars
 import json
 import os
+import threading
+import time
+from collections import deque
 from concurrent.futures import ThreadPoolExecutor
-from typing import Any, Dict, List, Optional
+from dataclasses import dataclass, replace
+from typing import Any, Deque, Dict, List, Optional, Tuple
 
 from dotenv import load_dotenv
 from langchain_core.prompts import PromptTemplate
 from langchain_openai import OpenAI
-from litellm import completion
+from litellm import acompletion, completion
+from tqdm import tqdm
+
+from budget import record_usage
+from profiling import follow_stage
+from prompt_sizing import (
+    PromptTooLarge,
+    context_budget,
+    count_tokens,
+    fit_resources,
+    output_allowance,
+    size_report,
+    trim_to_tokens,
+)
+from stage_profiles import GenerationProfile, base_stage, batch_profile, generation_params, record_stage_output, stage_profile
 
 load_dotenv()
 
 # Initialize LLM lazily to avoid key requirements at import time
 llm = None
+_llm_lock = threading.Lock()
+_race_loop: Optional[asyncio.AbstractEventLoop] = None
+_race_loop_lock = threading.Lock()
+
+
+def env_flag(name: str, default: bool = False) -> bool:
+    value = os.getenv(name)
+    if value is None or value.strip() == "":
+        return default
+    return value.strip().lower() in ("1", "true", "yes", "on")
+
+
+def build_messages(prompt: str, system: Optional[str] = None, cache_system: bool = False) -> List[Dict[str, Any]]:
+    """Build chat messages with the static system prefix first so providers can reuse it."""
+    messages: List[Dict[str, Any]] = []
+    if system:
+        if cache_system:
+            messages.append({
+                "role": "system",
+                "content": [{"type": "text", "text": system, "cache_control": {"type": "ephemeral"}}],
+            })
+        else:
+            messages.append({"role": "system", "content": system})
+    messages.append({"role": "user", "content": prompt})
+    return messages
+
+
+def flatten_prompt(prompt: str, system: Optional[str] = None) -> str:
+    """Join system and user content for completion-style endpoints, keeping the static prefix first."""
+    return f"{system}\n\n{prompt}" if system else prompt
+
+
+def litellm_cost(response: Any) -> float:
+    try:
+        from litellm import completion_cost
+
+        return float(completion_cost(completion_response=response) or 0.0)
+    except Exception:
+        return 0.0
+
+
+def supports_prompt_caching(model: str) -> bool:
+    try:
+        from litellm import supports_prompt_caching as _supports
+
+        return bool(_supports(model=model))
+    except Exception:
+        return False
+
+
+def litellm_context_window(model: str) -> Optional[int]:
+    try:
+        from litellm import get_model_info
+
+        return get_model_info(model=model).get("max_input_tokens")
+    except Exception:
+        return None
+
+
+def supports_json_mode(model: str) -> bool:
+    try:
+        from litellm import get_supported_openai_params
+
+        return "response_format" in (get_supported_openai_params(model=model) or [])
+    except Exception:
+        return False
+
+
+class LatencyTracker:
+    """Rolling window of observed call latencies used to pick a hedging delay."""
+    def __init__(self, window: int = 200):
+        self.samples: Deque[float] = deque(maxlen=window)
+        self.lock = threading.Lock()
+
+    def record(self, seconds: float) -> None:
+        with self.lock:
+            self.samples.append(seconds)
+
+    def percentile(self, pct: float, min_samples: int) -> Optional[float]:
+        with self.lock:
+            if len(self.samples) < max(1, min_samples):
+                return None
+            ordered = sorted(self.samples)
+        index = min(len(ordered) - 1, int(round(pct / 100.0 * (len(ordered) - 1))))
+        return ordered[index]
+
+
+def race_loop() -> asyncio.AbstractEventLoop:
+    """Event loop on a daemon thread that runs every racing call, instead of a new loop per call."""
+    global _race_loop
+    with _race_loop_lock:
+        if _race_loop is None:
+            _race_loop = asyncio.new_event_loop()
+            threading.Thread(target=_race_loop.run_forever, name="llm-race-loop", daemon=True).start()
+        return _race_loop
 
 
 class LiteLLMWrapper:
-    """Wrapper for LiteLLM API calls."""
-    def __init__(self, model: str, temperature: float, max_tokens: int, api_key: Optional[str] = None, base_url: Optional[str] = None):
+    """Wrapper for LiteLLM API calls.
+
+    With ``fallback_models`` configured, errors fail over to the next model in order. With
+    ``hedge_percentile`` set, a call still running after that percentile of the stage's observed
+    latency races a duplicate against the next model (or the same one) and keeps the first success.
+    """
+    def __init__(
+        self,
+        model: str,
+        temperature: float,
+        max_tokens: int,
+        api_key: Optional[str] = None,
+        base_url: Optional[str] = None,
+        fallback_models: Optional[List[str]] = None,
+        hedge_percentile: float = 0.0,
+        hedge_min_samples: int = 10,
+    ):
         self.model = model
         self.temperature = temperature
         self.max_tokens = max_tokens
         self.api_key = api_key
         self.base_url = base_url
-
-    def invoke(self, prompt: str) -> str:
+        self.fallback_models = [name for name in (fallback_models or []) if name and name != model]
+        self.hedge_percentile = hedge_percentile
+        self.hedge_min_samples = hedge_min_samples
+        self.latency: Dict[str, LatencyTracker] = {}
+        self.latency_lock = threading.Lock()
+        self.context_window = litellm_context_window(model)
+        # Explicit cache_control hints are only sent to models litellm knows honor them;
+        # other providers (e.g. OpenAI) cache stable prefixes automatically.
+        self.prompt_cache = env_flag("LLM_PROMPT_CACHE", True)
+
+    def _kwargs(self, model: str, prompt: str, system: Optional[str], profile: Optional[GenerationProfile] = None) -> Dict[str, Any]:
         kwargs = {
-            "model": self.model,
-            "messages": [{"role": "user", "content": prompt}],
-            "max_tokens": self.max_tokens,
-            "temperature": self.temperature,
+            "model": model,
+            "messages": build_messages(prompt, system, cache_system=self.prompt_cache and supports_prompt_caching(model)),
+            **generation_params(profile, self.max_tokens, self.temperature),
         }
-        if self.api_key and self.api_key != "your_openrouter_api_key_here":
-            kwargs["api_key"] = self.api_key
-        if self.base_url:
-            kwargs["api_base"] = self.base_url
-
-        try:
-            response = completion(**kwargs)
-            return response.choices[0].message.content
-        except Exception as exc:
-            raise ValueError(f"LiteLLM call failed: {exc}") from exc
+        if profile is not None and profile.json_mode and supports_json_mode(model):
+            kwargs["response_format"] = {"type": "json_object"}
+        # Fallbacks on another provider resolve their own credentials from the environment.
+        if model.split("/", 1)[0] == self.model.split("/", 1)[0]:
+            if self.api_key and self.api_key != "your_openrouter_api_key_here":
+                kwargs["api_key"] = self.api_key
+            if self.base_url:
+                kwargs["api_base"] = self.base_url
+        return kwargs
+
+    def tracker(self, stage: Optional[str]) -> LatencyTracker:
+        """Latency samples for one stage, so short JSON calls don't set the hedge delay for long drafts."""
+        name = base_stage(stage or "")
+        with self.latency_lock:
+            return self.latency.setdefault(name, LatencyTracker())
+
+    def invoke(
+        self, prompt: str, system: Optional[str] = None, profile: Optional[GenerationProfile] = None, stage: Optional[str] = None
+    ) -> str:
+        if not self.fallback_models and self.hedge_percentile <= 0:
+            try:
+                started = time.monotonic()
+                response = completion(**self._kwargs(self.model, prompt, system, profile))
+                self.tracker(stage).record(time.monotonic() - started)
+            except Exception as exc:
+                raise ValueError(f"LiteLLM call failed: {exc}") from exc
+        else:
+            racing = self._invoke_racing(prompt, system, profile, self.tracker(stage))
+            response = asyncio.run_coroutine_threadsafe(racing, race_loop()).result()
+        # Recorded on the calling thread, where the song's usage meter is active.
+        content = response.choices[0].message.content
+        record_usage(response, flatten_prompt(prompt, system), content, litellm_cost(response))
+        return content
+
+    async def _call(
+        self, model: str, prompt: str, system: Optional[str], profile: Optional[GenerationProfile], latency: LatencyTracker
+    ) -> Any:
+        started = time.monotonic()
+        response = await acompletion(**self._kwargs(model, prompt, system, profile))
+        latency.record(time.monotonic() - started)
+        return response
+
+    async def _invoke_racing(
+        self, prompt: str, system: Optional[str], profile: Optional[GenerationProfile], latency: LatencyTracker
+    ) -> Any:
+        targets = [self.model, *self.fallback_models]
+        next_target = 0
+        hedged = False
+        pending: set = set()
+        task_models: Dict[asyncio.Future, str] = {}
+        errors: List[str] = []
+
+        def launch(model: str) -> None:
+            task = asyncio.ensure_future(self._call(model, prompt, system, profile, latency))
+            task_models[task] = model
+            pending.add(task)
+
+        launch(targets[next_target])
+        next_target += 1
+        hedge_delay = None
+        if self.hedge_percentile > 0:
+            hedge_delay = latency.percentile(self.hedge_percentile, self.hedge_min_samples)
+
+        while pending:
+            timeout = hedge_delay if hedge_delay is not None and not hedged else None
+            done, pending = await asyncio.wait(pending, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+            if not done:
+                hedged = True
+                if next_target < len(targets):
+                    launch(targets[next_target])
+                    next_target += 1
+                else:
+                    launch(self.model)
+                continue
+            for task in done:
+                if task.exception() is None:
+                    for loser in pending:
+                        loser.cancel()
+                    if pending:
+                        await asyncio.gather(*pending, return_exceptions=True)
+                    return task.result()
+                errors.append(f"{task_models[task]}: {task.exception()}")
+            if not pending and next_target < len(targets):
+                launch(targets[next_target])
+                next_target += 1
+        raise ValueError(f"LiteLLM call failed on all models: {'; '.join(errors)}")
 
 
 def get_llm(use_local: bool = False):
-    global llm
     if llm is not None:
         return llm
+    # Concurrent workers in one process share a single client; build it only once.
+    with _llm_lock:
+        return llm if llm is not None else _build_llm(use_local)
 
+
+def _build_llm(use_local: bool):
+    global llm
     temperature = float(os.getenv("LLM_TEMPERATURE", "0.1"))
     max_tokens = int(os.getenv("LLM_MAX_TOKENS", "4096"))
 
@@ -60,36 +279,61 @@ def get_llm(use_local: bool = False):
 
         import openai
 
+        from endpoint_capabilities import invalidate_capabilities, load_capabilities
+
         class LMStudioLLM:
             def __init__(self, model: str, temperature: float, max_tokens: int, api_key: str, base_url: str):
                 self.model = model
                 self.temperature = temperature
                 self.max_tokens = max_tokens
+                self.base_url = base_url
                 self.client = openai.OpenAI(api_key=api_key, base_url=base_url)
+                # Ask llama.cpp-based servers to keep the KV cache of the shared prefix,
+                # optionally pinned to a slot so consecutive calls land on the same cache.
+                self.extra_body: Dict[str, Any] = {}
+                if env_flag("LMSTUDIO_CACHE_PROMPT", True):
+                    self.extra_body["cache_prompt"] = True
+                slot_id = os.getenv("LMSTUDIO_SLOT_ID")
+                if slot_id:
+                    self.extra_body["id_slot"] = int(slot_id)
+                self.capabilities = load_capabilities(self.client, base_url, model, api_key)
+                if self.capabilities.endpoint is None:
+                    raise ValueError(
+                        f"LM Studio connection failed. {base_url} answered neither chat nor completions requests "
+                        f"for model {model}."
+                    )
+                self.context_window = self.capabilities.context_length
 
-            def invoke(self, prompt: str) -> str:
+            def invoke(
+                self, prompt: str, system: Optional[str] = None, profile: Optional[GenerationProfile] = None, stage: Optional[str] = None
+            ) -> str:
+                endpoint = self.capabilities.endpoint
+                params = generation_params(profile, self.max_tokens, self.temperature)
                 try:
-                    completion = self.client.chat.completions.create(
-                        model=self.model,
-                        messages=[{"role": "user", "content": prompt}],
-                        max_tokens=self.max_tokens,
-                        temperature=self.temperature,
-                    )
-                    return completion.choices[0].message.content
-                except Exception as chat_exc:
-                    try:
+                    if endpoint == "chat":
+                        if profile is not None and profile.json_mode and self.capabilities.json_mode:
+                            params["response_format"] = {"type": "json_object"}
+                        completion = self.client.chat.completions.create(
+                            model=self.model,
+                            messages=build_messages(prompt, system),
+                            extra_body=self.extra_body or None,
+                            **params,
+                        )
+                        content = completion.choices[0].message.content
+                    else:
                         completion = self.client.completions.create(
                             model=self.model,
-                            prompt=prompt,
-                            max_tokens=self.max_tokens,
-                            temperature=self.temperature,
+                            prompt=flatten_prompt(prompt, system),
+                            extra_body=self.extra_body or None,
+                            **params,
                         )
-                        return completion.choices[0].text
-                    except Exception as completion_exc:
-                        raise ValueError(
-                            "LM Studio connection failed. Tried both chat and completions endpoints. "
-                            f"Original errors: {chat_exc}, {completion_exc}"
-                        ) from completion_exc
+                        content = completion.choices[0].text
+                except Exception as exc:
+                    # The server may have been reconfigured since the probe; re-probe on the next run.
+                    invalidate_capabilities(self.base_url, self.model)
+                    raise ValueError(f"LM Studio {endpoint} request failed: {exc}") from exc
+                record_usage(completion, flatten_prompt(prompt, system), content)
+                return content
 
         llm = LMStudioLLM(
             model=lmstudio_model,
@@ -111,6 +355,9 @@ def get_llm(use_local: bool = False):
             max_tokens=max_tokens,
             api_key=litellm_api_key,
             base_url=litellm_base_url,
+            fallback_models=[name.strip() for name in os.getenv("LITELLM_FALLBACK_MODELS", "").split(",")],
+            hedge_percentile=float(os.getenv("LLM_HEDGE_PERCENTILE", "0")),
+            hedge_min_samples=int(os.getenv("LLM_HEDGE_MIN_SAMPLES", "10")),
         )
         return llm
 
@@ -128,14 +375,17 @@ def get_llm(use_local: bool = False):
                 self.max_tokens = max_tokens
                 self.client = openai.OpenAI(api_key=api_key, base_url=base_url)
 
-            def invoke(self, prompt: str) -> str:
+            def invoke(
+                self, prompt: str, system: Optional[str] = None, profile: Optional[GenerationProfile] = None, stage: Optional[str] = None
+            ) -> str:
                 completion = self.client.completions.create(
                     model=self.model,
-                    prompt=prompt,
-                    max_tokens=self.max_tokens,
-                    temperature=self.temperature,
+                    prompt=flatten_prompt(prompt, system),
+                    **generation_params(profile, self.max_tokens, self.temperature),
                 )
-                return completion.choices[0].text
+                content = completion.choices[0].text
+                record_usage(completion, flatten_prompt(prompt, system), content)
+                return content
 
         llm = OpenRouterLLM(
             model=model,
@@ -150,15 +400,55 @@ def get_llm(use_local: bool = False):
     if not openai_api_key:
         raise ValueError("Neither OPENROUTER_API_KEY nor OPENAI_API_KEY found in environment variables")
 
-    llm = OpenAI(
-        temperature=temperature,
-        model=model,
-        max_tokens=max_tokens,
-        openai_api_key=openai_api_key,
+    llm = LangChainLLMWrapper(
+        OpenAI(
+            temperature=temperature,
+            model=model,
+            max_tokens=max_tokens,
+            openai_api_key=openai_api_key,
+        )
     )
     return llm
 
 
+class LangChainLLMWrapper:
+    """Adapter giving LangChain completion models the same invoke signature as the other wrappers."""
+    def __init__(self, model):
+        self.model = model
+
+    def invoke(
+        self, prompt: str, system: Optional[str] = None, profile: Optional[GenerationProfile] = None, stage: Optional[str] = None
+    ) -> str:
+        full_prompt = flatten_prompt(prompt, system)
+        if profile is None:
+            content = self.model.invoke(full_prompt)
+        else:
+            params = generation_params(profile, self.model.max_tokens, self.model.temperature)
+            content = self.model.invoke(full_prompt, **params)
+        record_usage(None, full_prompt, content)
+        return content
+
+
+@dataclass
+class ChatPrompt:
+    """Prompt split into a static system prefix and per-call user content.
+
+    The system part only depends on instructions and canonicalized resources, so it renders
+    byte-identical across calls and runs and can be served from provider/local prefix caches.
+    """
+    system: PromptTemplate
+    user: PromptTemplate
+
+    @property
+    def input_variables(self) -> List[str]:
+        return list(dict.fromkeys(self.system.input_variables + self.user.input_variables))
+
+    def format(self, **kwargs: Any) -> Tuple[str, str]:
+        system = self.system.format(**{key: kwargs[key] for key in self.system.input_variables})
+        user = self.user.format(**{key: kwargs[key] for key in self.user.input_variables})
+        return system, user
+
+
 def build_prompts():
     """Build and return all prompt templates for song generation."""
     from helpers import read_prompt
@@ -197,100 +487,104 @@ def build_prompts():
         "- Return only the revised lyrics, no commentary."
     )
 
-    song_drafter_prompt = PromptTemplate(
-        input_variables=["user_input", "styles", "tags", "persona_styles", "default_params"],
-        template=f"""
+    song_drafter_prompt = ChatPrompt(
+        system=PromptTemplate(
+            input_variables=["styles", "tags"],
+            template=f"""
 {song_drafter_template}
 
 Data and Resources:
 - Styles: {{styles}}
 - Tags: {{tags}}
-- Persona Styles: {{persona_styles}}
-- Default Song Parameters: {{default_params}}
+""",
+        ),
+        user=PromptTemplate(
+            input_variables=["user_input", "persona_styles", "default_params"],
+            template="""
+- Persona Styles: {persona_styles}
+- Default Song Parameters: {default_params}
 
-User Input: {{user_input}}
+User Input: {user_input}
 
 Use the default song parameters as a baseline when creating the song, but adapt them based on the user's specific request.
 Output your draft as a basic song structure plus lyrics.
 """,
+        ),
     )
 
-    song_review_prompt = PromptTemplate(
-        input_variables=["lyrics"],
-        template=f"""
-{song_review_template}
-
-Lyrics: {{lyrics}}
-""",
+    song_review_prompt = ChatPrompt(
+        system=PromptTemplate(input_variables=[], template=song_review_template),
+        user=PromptTemplate(input_variables=["lyrics"], template="Lyrics: {lyrics}\n"),
     )
 
-    song_critic_prompt = PromptTemplate(
-        input_variables=["lyrics"],
-        template=f"""
-{song_critic_template}
-
-Lyrics: {{lyrics}}
-""",
+    song_critic_prompt = ChatPrompt(
+        system=PromptTemplate(input_variables=[], template=song_critic_template),
+        user=PromptTemplate(input_variables=["lyrics"], template="Lyrics: {lyrics}\n"),
     )
 
-    song_preflight_prompt = PromptTemplate(
-        input_variables=["lyrics", "styles", "tags"],
-        template=f"""
+    song_preflight_prompt = ChatPrompt(
+        system=PromptTemplate(
+            input_variables=["styles", "tags"],
+            template=f"""
 {song_preflight_template}
 
 Styles: {{styles}}
 Tags: {{tags}}
-
-Lyrics: {{lyrics}}
 """,
+        ),
+        user=PromptTemplate(input_variables=["lyrics"], template="Lyrics: {lyrics}\n"),
     )
 
-    song_revision_prompt = PromptTemplate(
-        input_variables=["lyrics", "feedback"],
-        template=f"""{song_revision_template}
-
-Lyrics:
-{{lyrics}}
+    song_revision_prompt = ChatPrompt(
+        system=PromptTemplate(input_variables=[], template=song_revision_template),
+        user=PromptTemplate(
+            input_variables=["lyrics", "feedback"],
+            template="""Lyrics:
+{lyrics}
 
 Reviewer Feedback:
-{{feedback}}
+{feedback}
 """,
+        ),
     )
 
-    metadata_prompt = PromptTemplate(
-        input_variables=["lyrics", "user_input", "default_params", "persona_styles"],
-        template=f"""{metadata_template}
-
-Lyrics:
-{{lyrics}}
+    metadata_prompt = ChatPrompt(
+        system=PromptTemplate(input_variables=[], template=metadata_template),
+        user=PromptTemplate(
+            input_variables=["lyrics", "user_input", "default_params", "persona_styles"],
+            template="""Lyrics:
+{lyrics}
 
 User Input:
-{{user_input}}
+{user_input}
 
 Default Parameters:
-{{default_params}}
+{default_params}
 
 Persona Styles:
-{{persona_styles}}
+{persona_styles}
 """,
+        ),
     )
 
-    preflight_triage_prompt = PromptTemplate(
-        input_variables=["preflight_output"],
-        template=f"""{preflight_triage_template}
-
-Preflight Feedback:
-{{preflight_output}}
+    preflight_triage_prompt = ChatPrompt(
+        system=PromptTemplate(input_variables=[], template=preflight_triage_template),
+        user=PromptTemplate(
+            input_variables=["preflight_output"],
+            template="""Preflight Feedback:
+{preflight_output}
 """,
+        ),
     )
 
-    song_score_prompt = PromptTemplate(
-        input_variables=["lyrics"],
-        template=f"""{scoring_template}
-
-Lyrics:
-{{lyrics}}
+    song_score_prompt = ChatPrompt(
+        system=PromptTemplate(input_variables=[], template=scoring_template),
+        user=PromptTemplate(
+            input_variables=["lyrics"],
+            template="""Lyrics:
+{lyrics}
 """,
+        ),
     )
 
     return (
@@ -305,45 +599,279 @@ Lyrics:
     )
 
 
-def draft_song(prompt_template: PromptTemplate, enhanced_input: str, styles: Dict[str, str], tags: Dict[str, str], persona_styles: str, default_params: Dict[str, Optional[str]], use_local: bool) -> str:
-    formatted_prompt = prompt_template.format(
-        user_input=enhanced_input,
-        styles=str(styles),
-        tags=str(tags),
-        persona_styles=persona_styles,
-        default_params=str(default_params),
-    )
-    return get_llm(use_local).invoke(formatted_prompt)
+def context_window(use_local: bool) -> Optional[int]:
+    """Context window of the active model: LLM_CONTEXT_WINDOW, else what the backend reports."""
+    override = os.getenv("LLM_CONTEXT_WINDOW")
+    if override:
+        return int(override)
+    from cassette import active_cassette
+
+    cassette = active_cassette()
+    if cassette is not None and cassette.mode == "replay":
+        # Replays never contact a backend; set LLM_CONTEXT_WINDOW to reproduce recorded reductions.
+        return None
+    return getattr(get_llm(use_local), "context_window", None)
+
+
+def output_cap(profile: GenerationProfile) -> int:
+    return generation_params(profile, int(os.getenv("LLM_MAX_TOKENS", "4096")), 0.0)["max_tokens"]
+
+
+def prompt_budget(stage: str, use_local: bool, profile: Optional[GenerationProfile] = None) -> Optional[int]:
+    """Prompt tokens available to a stage once its output is reserved, or None when the window is unknown."""
+    return context_budget(context_window(use_local), output_cap(profile or stage_profile(stage)))
+
+
+def check_prompt_size(
+    stage: str, prompt: str, use_local: bool, system: Optional[str] = None, profile: Optional[GenerationProfile] = None
+) -> GenerationProfile:
+    """Log prompt token counts (LOG_PROMPT_TOKENS) and fit the call's output cap to the context window.
+
+    Returns the profile to send, with max_tokens lowered to what is left after the prompt. Raises
+    PromptTooLarge only when not even PROMPT_MIN_OUTPUT_TOKENS (or the stage cap, if smaller) is left.
+    """
+    profile = profile or stage_profile(stage)
+    window = context_window(use_local)
+    log = env_flag("LOG_PROMPT_TOKENS")
+    if window is None and not log:
+        return profile
+    parts = {"system": count_tokens(system), "user": count_tokens(prompt)}
+    if log:
+        tqdm.write(size_report(stage, parts, prompt_budget(stage, use_local, profile)))
+    allowance = output_allowance(window, sum(parts.values()))
+    if allowance is None:
+        return profile
+    cap = output_cap(profile)
+    if allowance < min(cap, int(os.getenv("PROMPT_MIN_OUTPUT_TOKENS", "256"))):
+        raise PromptTooLarge(
+            f"{size_report(stage, parts, None)} leaves {max(0, allowance)} of the {window}-token context window for output"
+        )
+    if allowance < cap:
+        tqdm.write(f"! {stage} output capped at {allowance} tokens to fit the {window}-token context window")
+        return replace(profile, max_tokens=allowance)
+    return profile
+
+
+def call_llm(
+    stage: str, prompt: str, use_local: bool, system: Optional[str] = None, profile: Optional[GenerationProfile] = None
+) -> str:
+    """Single entry point for stage LLM calls; serves or records them when a cassette is active.
+
+    Each call uses the stage's generation profile (output cap, temperature, stop sequences, JSON mode)
+    unless ``profile`` is given, and is checked against the model's context window before it is sent.
+    """
+    from cassette import active_cassette
+
+    profile = check_prompt_size(stage, prompt, use_local, system, profile)
+    cassette = active_cassette()
+    if cassette is not None and cassette.mode == "replay":
+        content = cassette.text(stage, system, prompt, call=None)
+        record_usage(None, flatten_prompt(prompt, system), content)
+        return content
+    if cassette is None:
+        content = get_llm(use_local).invoke(prompt, system=system, profile=profile, stage=stage)
+    else:
+        content = cassette.text(
+            stage, system, prompt, call=lambda: get_llm(use_local).invoke(prompt, system=system, profile=profile, stage=stage)
+        )
+    record_stage_output(stage, content)
+    return content
+
+
+def draft_song(prompt_template: ChatPrompt, enhanced_input: str, styles: Dict[str, str], tags: Dict[str, str], persona_styles: str, default_params: Dict[str, Optional[str]], use_local: bool) -> str:
+    from helpers import render_params, render_resources
+
+    def _render(kept_styles, kept_tags):
+        return prompt_template.format(
+            user_input=enhanced_input,
+            styles=render_resources(kept_styles),
+            tags=render_resources(kept_tags),
+            persona_styles=persona_styles,
+            default_params=render_params(default_params),
+        )
+
+    system, formatted_prompt = fit_stage_resources("draft", _render, styles, tags, use_local)
+    return call_llm("draft", formatted_prompt, use_local, system=system)
+
+
+def fit_stage_resources(stage: str, render, styles: Dict[str, str], tags: Dict[str, str], use_local: bool) -> Tuple[str, str]:
+    """Render a resource-heavy prompt, dropping low-priority style/tag sections if it exceeds the context window."""
+    budget = prompt_budget(stage, use_local)
+    if budget is None:
+        return render(styles, tags)
+    system, formatted_prompt, dropped = fit_resources(render, styles, tags, budget)
+    if dropped:
+        tqdm.write(f"! {stage} prompt trimmed to fit {budget} tokens; dropped {', '.join(dropped)}")
+    return system, formatted_prompt
+
 
+def revision_feedback_budget(prompt_template: ChatPrompt, lyrics: str, use_local: bool) -> Optional[int]:
+    """Tokens left for feedback in a revision of ``lyrics``, or None when the context window is unknown."""
+    budget = prompt_budget("revise", use_local)
+    if budget is None:
+        return None
+    base_system, base_prompt = prompt_template.format(lyrics=lyrics, feedback="")
+    return max(0, budget - count_tokens(base_system) - count_tokens(base_prompt))
 
-def revise_lyrics(prompt_template: PromptTemplate, lyrics: str, feedback: str, use_local: bool) -> str:
-    formatted_prompt = prompt_template.format(lyrics=lyrics, feedback=feedback)
-    return get_llm(use_local).invoke(formatted_prompt)
 
+def trim_feedback(label: str, text: str, budget: int) -> str:
+    """``trim_to_tokens`` that logs when a non-empty feedback section is cut down to nothing."""
+    trimmed = trim_to_tokens(text, budget)
+    if text.strip() and not trimmed:
+        tqdm.write(f"! {label} dropped: no room left within {budget} tokens")
+    return trimmed
 
-def run_parallel_reviews(prompt_template: PromptTemplate, lyrics: str, use_local: bool, reviewer_count: int = 3) -> str:
-    """Run multiple AI reviewers in parallel and merge their feedback."""
-    def _call(_):
-        formatted_prompt = prompt_template.format(lyrics=lyrics)
-        return get_llm(use_local).invoke(formatted_prompt)
 
+def revise_lyrics(prompt_template: ChatPrompt, lyrics: str, feedback: str, use_local: bool) -> str:
+    budget = revision_feedback_budget(prompt_template, lyrics, use_local)
+    if budget is not None:
+        # Review feedback is already sized by rank (merge_reviews / gather_merged_feedback); this only
+        # catches feedback that could not be shrunk upstream, such as a long critic or preflight list.
+        trimmed = trim_feedback("revise feedback", feedback, budget)
+        if trimmed != feedback:
+            tqdm.write(f"! revise feedback trimmed from {count_tokens(feedback)} to {count_tokens(trimmed)} tokens")
+            feedback = trimmed
+    system, formatted_prompt = prompt_template.format(lyrics=lyrics, feedback=feedback)
+    return call_llm("revise", formatted_prompt, use_local, system=system)
+
+
+def run_parallel_reviews(
+    prompt_template: ChatPrompt, lyrics: str, use_local: bool, reviewer_count: int = 3, token_budget: Optional[int] = None
+) -> str:
+    """Run multiple AI reviewers in parallel and merge their feedback.
+
+    By default the feedback is consolidated locally into a de-duplicated list grouped by lyric
+    section, with (n/total) marking how many reviewers raised each point.
+    """
+    return merge_reviews(collect_reviews(prompt_template, lyrics, use_local, reviewer_count), lyrics, token_budget)
+
+
+def collect_reviews(prompt_template: ChatPrompt, lyrics: str, use_local: bool, reviewer_count: int = 3) -> List[str]:
+    system, formatted_prompt = prompt_template.format(lyrics=lyrics)
+
+    def _call(idx):
+        # Reviewers get distinct stage names so recorded feedback replays in reviewer order.
+        return call_llm(f"review[{idx}]", formatted_prompt, use_local, system=system)
+
+    # Copy the caller's context into each worker so usage is metered against the right song.
+    contexts = [contextvars.copy_context() for _ in range(reviewer_count)]
+    call = follow_stage(_call)
     with ThreadPoolExecutor(max_workers=reviewer_count) as executor:
-        feedbacks = list(executor.map(_call, range(reviewer_count)))
-    merged = "\n\n".join([f"Reviewer {idx + 1} Feedback:\n{fb}" for idx, fb in enumerate(feedbacks)])
-    return merged
+        return list(executor.map(lambda idx: contexts[idx].run(call, idx), range(reviewer_count)))
+
+
+def merge_reviews(feedbacks: List[str], lyrics: str, token_budget: Optional[int] = None) -> str:
+    """Combine reviewer feedback, fitting it into ``token_budget`` tokens when given.
+
+    Consolidated feedback drops the suggestions fewest reviewers share; raw feedback keeps the
+    opening lines of every reviewer within an equal share of the budget.
+    """
+    limit = int(os.getenv("FEEDBACK_TOKEN_BUDGET", "600"))
+    if token_budget is not None:
+        limit = min(limit, token_budget)
+    if env_flag("FEEDBACK_CONSOLIDATE", True):
+        from helpers import consolidate_feedback
+
+        consolidated = consolidate_feedback(feedbacks, lyrics, token_budget=limit)
+        # Fall back to the raw feedback if it had no recognizable suggestions.
+        if consolidated:
+            return consolidated
+    if token_budget is not None and feedbacks:
+        share = max(0, token_budget // len(feedbacks) - 8)
+        feedbacks = [trim_feedback(f"reviewer {idx + 1} feedback", fb or "", share) for idx, fb in enumerate(feedbacks)]
+    return "\n\n".join([f"Reviewer {idx + 1} Feedback:\n{fb}" for idx, fb in enumerate(feedbacks)])
+
+
+BATCH_INSTRUCTIONS = (
+    "\n\nSeveral independent items follow, each introduced by a line '### Item <id>'. "
+    "Apply the instructions above to every item separately. Return only a JSON array with one object per item, "
+    'each containing an "id" key (the item id as a string) plus the keys requested above. No markdown, no prose.'
+)
 
+_batchers: Dict[Tuple[str, str, bool], Any] = {}
+_batchers_lock = threading.Lock()
 
-def score_lyrics(prompt_template: PromptTemplate, lyrics: str, use_local: bool) -> float:
-    formatted_prompt = prompt_template.format(lyrics=lyrics)
+
+def _invoke_json_batch(
+    stage: str, system: str, prompts: List[str], use_local: bool, contexts: List[contextvars.Context]
+) -> List[str]:
+    """Answer several JSON-stage prompts sharing one system prefix with a single combined request.
+
+    Calls run in the callers' contexts; usage of the combined request is split evenly between them.
+    """
+    from budget import UsageMeter, activate_meter, deactivate_meter, share_usage
+
+    if len(prompts) == 1:
+        return [contexts[0].run(call_llm, stage, prompts[0], use_local, system=system)]
+
+    combined = "\n\n".join(f"### Item {idx}\n{prompt}" for idx, prompt in enumerate(prompts))
+    answers: Dict[str, str] = {}
+    shared = UsageMeter()
+    token = activate_meter(shared)
+    try:
+        parsed = json.loads(
+            call_llm(
+                f"{stage}_batch", combined, use_local, system=system + BATCH_INSTRUCTIONS, profile=batch_profile(stage, len(prompts))
+            )
+        )
+        for entry in parsed if isinstance(parsed, list) else []:
+            if isinstance(entry, dict) and "id" in entry:
+                item_id = str(entry.pop("id"))
+                answers[item_id] = json.dumps(entry)
+    except Exception:
+        answers = {}
+    finally:
+        deactivate_meter(token)
+        share_usage(shared, contexts)
+    # Anything the combined answer missed is asked for on its own so no caller loses its result.
+    return [
+        answers.get(str(idx)) or contexts[idx].run(call_llm, stage, prompt, use_local, system=system)
+        for idx, prompt in enumerate(prompts)
+    ]
+
+
+def invoke_coalesced(stage: str, system: str, prompt: str, use_local: bool) -> str:
+    """Invoke a small JSON stage, coalescing concurrent calls across songs on local servers.
+
+    Local servers largely process requests serially, so when LOCAL_BATCH_WINDOW_MS is set and
+    several songs run in this process (``--worker --concurrency N``), calls with the same system
+    prefix that arrive within the window are sent as one combined prompt.
+    """
+    from budget import active_runs
+    from cassette import active_cassette
+
+    window_ms = float(os.getenv("LOCAL_BATCH_WINDOW_MS", "0"))
+    # Batch composition depends on timing, so cassette runs stay unbatched to remain deterministic.
+    # With a single song in flight nothing can join the batch, so don't wait out the window.
+    if not use_local or window_ms <= 0 or active_cassette() is not None or active_runs() <= 1:
+        return call_llm(stage, prompt, use_local, system=system)
+
+    from request_batching import MicroBatcher
+
+    key = (stage, system, use_local)
+    with _batchers_lock:
+        batcher = _batchers.get(key)
+        if batcher is None:
+            batcher = MicroBatcher(
+                lambda prompts, contexts: _invoke_json_batch(stage, system, prompts, use_local, contexts),
+                window=window_ms / 1000.0,
+                max_items=int(os.getenv("LOCAL_BATCH_MAX_ITEMS", "8")),
+            )
+            _batchers[key] = batcher
+    return batcher.submit(prompt)
+
+
+def score_lyrics(prompt_template: ChatPrompt, lyrics: str, use_local: bool) -> float:
+    system, formatted_prompt = prompt_template.format(lyrics=lyrics)
     try:
-        raw = get_llm(use_local).invoke(formatted_prompt)
+        raw = invoke_coalesced("score", system, formatted_prompt, use_local)
         parsed = json.loads(raw)
         return float(parsed.get("score", 0))
     except Exception:
         return 0.0
 
 
-def review_song(prompt_template: PromptTemplate, revision_prompt: PromptTemplate, scoring_prompt: PromptTemplate, lyrics: str, use_local: bool, reviewer_count: int = 3, score_threshold: float = 8.0, max_rounds: int = 2) -> str:
+def review_song(prompt_template: ChatPrompt, revision_prompt: ChatPrompt, scoring_prompt: ChatPrompt, lyrics: str, use_local: bool, reviewer_count: int = 3, score_threshold: float = 8.0, max_rounds: int = 2) -> str:
     for _ in range(max_rounds):
         feedback = run_parallel_reviews(prompt_template, lyrics, use_local, reviewer_count=reviewer_count)
         lyrics = revise_lyrics(revision_prompt, lyrics, feedback, use_local)
@@ -353,25 +881,86 @@ def review_song(prompt_template: PromptTemplate, revision_prompt: PromptTemplate
     return lyrics
 
 
-def critique_song(prompt_template: PromptTemplate, revision_prompt: PromptTemplate, lyrics: str, use_local: bool) -> str:
-    formatted_prompt = prompt_template.format(lyrics=lyrics)
-    feedback = get_llm(use_local).invoke(formatted_prompt)
-    return revise_lyrics(revision_prompt, lyrics, feedback, use_local)
+def critic_feedback(prompt_template: ChatPrompt, lyrics: str, use_local: bool) -> str:
+    system, formatted_prompt = prompt_template.format(lyrics=lyrics)
+    return call_llm("critic", formatted_prompt, use_local, system=system)
+
 
+def critique_song(prompt_template: ChatPrompt, revision_prompt: ChatPrompt, lyrics: str, use_local: bool) -> str:
+    feedback = critic_feedback(prompt_template, lyrics, use_local)
+    return revise_lyrics(revision_prompt, lyrics, feedback, use_local)
 
-def preflight_song(prompt_template: PromptTemplate, lyrics: str, styles: Dict[str, str], tags: Dict[str, str], use_local: bool) -> None:
-    formatted_prompt = prompt_template.format(lyrics=lyrics, styles=str(styles), tags=str(tags))
-    return get_llm(use_local).invoke(formatted_prompt)
 
+def preflight_song(prompt_template: ChatPrompt, lyrics: str, styles: Dict[str, str], tags: Dict[str, str], use_local: bool) -> None:
+    from helpers import render_resources
+
+    def _render(kept_styles, kept_tags):
+        return prompt_template.format(lyrics=lyrics, styles=render_resources(kept_styles), tags=render_resources(kept_tags))
+
+    system, formatted_prompt = fit_stage_resources("preflight", _render, styles, tags, use_local)
+    return call_llm("preflight", formatted_prompt, use_local, system=system)
+
+
+def gather_merged_feedback(
+    review_prompt: ChatPrompt,
+    critic_prompt: ChatPrompt,
+    lyrics: str,
+    use_local: bool,
+    preflight_prompt: Optional[ChatPrompt] = None,
+    triage_prompt: Optional[ChatPrompt] = None,
+    styles: Optional[Dict[str, str]] = None,
+    tags: Optional[Dict[str, str]] = None,
+    token_budget: Optional[int] = None,
+) -> Tuple[str, Optional[Dict[str, Any]]]:
+    """Run the reviewers, the critic and (when prompts are given) preflight analysis concurrently.
+
+    Returns one combined feedback text for a single revision, plus the preflight triage result
+    (None when preflight was not part of the pass). With ``token_budget``, preflight issues are
+    always kept; the critic gets at most half of what remains and reviewer feedback the rest,
+    dropping its least-shared suggestions first.
+    """
+    tasks = {
+        "reviews": lambda: collect_reviews(review_prompt, lyrics, use_local),
+        "critic": lambda: critic_feedback(critic_prompt, lyrics, use_local),
+    }
+    if preflight_prompt is not None and triage_prompt is not None:
+        tasks["preflight"] = lambda: triage_preflight(
+            triage_prompt, preflight_song(preflight_prompt, lyrics, styles or {}, tags or {}, use_local), use_local
+        )
 
-def triage_preflight(prompt_template: PromptTemplate, preflight_output: str, use_local: bool):
+    # Same per-worker context copy as run_parallel_reviews so usage lands on this song's meter.
+    with ThreadPoolExecutor(max_workers=len(tasks)) as executor:
+        futures = {name: executor.submit(contextvars.copy_context().run, follow_stage(task)) for name, task in tasks.items()}
+        results = {name: future.result() for name, future in futures.items()}
+
+    triaged = results.get("preflight")
+    issues = ""
+    if triaged and not triaged.get("pass") and triaged.get("issues"):
+        issues = "Preflight Issues (must fix):\n" + "\n".join(f"- {issue}" for issue in triaged["issues"])
+    critic = results["critic"] or ""
+    reviews_budget = None
+    if token_budget is not None:
+        remaining = max(0, token_budget - count_tokens(issues) - count_tokens("Reviewer Feedback:\nCritic Feedback:\n") - 4)
+        critic = trim_feedback("critic feedback", critic, remaining // 2)
+        reviews_budget = remaining - count_tokens(critic)
+
+    sections = [
+        f"Reviewer Feedback:\n{merge_reviews(results['reviews'], lyrics, reviews_budget)}",
+        f"Critic Feedback:\n{critic}",
+    ]
+    if issues:
+        sections.append(issues)
+    return "\n\n".join(sections), triaged
+
+
+def triage_preflight(prompt_template: ChatPrompt, preflight_output: str, use_local: bool):
     """Parse preflight feedback and determine if issues exist."""
     fallback = {"pass": False, "issues": ["Preflight feedback could not be parsed. Review manually."]}
     if not preflight_output:
         return fallback
-    formatted = prompt_template.format(preflight_output=preflight_output)
+    system, formatted = prompt_template.format(preflight_output=preflight_output)
     try:
-        raw = get_llm(use_local).invoke(formatted)
+        raw = invoke_coalesced("triage", system, formatted, use_local)
         parsed = json.loads(raw)
         passed = bool(parsed.get("pass", False))
         issues = parsed.get("issues", [])
@@ -383,8 +972,8 @@ def triage_preflight(prompt_template: PromptTemplate, preflight_output: str, use
         return fallback
 
 
-def generate_metadata_summary(prompt_template: PromptTemplate, lyrics: str, user_input: str, default_params: Dict[str, Optional[str]], persona_styles: str, use_local: bool):
-    from helpers import parse_persona_styles_list
+def generate_metadata_summary(prompt_template: ChatPrompt, lyrics: str, user_input: str, default_params: Dict[str, Optional[str]], persona_styles: str, use_local: bool):
+    from helpers import parse_persona_styles_list, render_params
 
     persona_style_tokens = parse_persona_styles_list(persona_styles)
     fallback = {
@@ -394,14 +983,14 @@ def generate_metadata_summary(prompt_template: PromptTemplate, lyrics: str, user
         "target_audience": "Suggested demographic",
         "commercial_potential": "Assessment",
     }
-    formatted_prompt = prompt_template.format(
+    system, formatted_prompt = prompt_template.format(
         lyrics=lyrics,
         user_input=user_input,
-        default_params=str(default_params),
+        default_params=render_params(default_params),
         persona_styles=persona_styles or "None provided",
     )
     try:
-        raw = get_llm(use_local).invoke(formatted_prompt)
+        raw = call_llm("metadata", formatted_prompt, use_local, system=system)
         parsed = json.loads(raw)
         description = parsed.get("description") or fallback["description"]
         styles = parsed.get("suno_styles") or fallback["suno_styles"]
@@ -0,0 +1,170 @@
+import os
+import threading
+import time
+from contextvars import Context, ContextVar
+from dataclasses import dataclass, field
+from typing import Any, Dict, List, Optional
+
+_current_meter: ContextVar[Optional["UsageMeter"]] = ContextVar("song_usage_meter", default=None)
+
+
+@dataclass
+class UsageMeter:
+    """Accumulates tokens and cost of LLM calls; usage also rolls up into an optional parent meter."""
+    started: float = field(default_factory=time.time)
+    prompt_tokens: int = 0
+    completion_tokens: int = 0
+    cost: float = 0.0
+    parent: Optional["UsageMeter"] = None
+    lock: threading.Lock = field(default_factory=threading.Lock, repr=False)
+
+    @property
+    def total_tokens(self) -> int:
+        return self.prompt_tokens + self.completion_tokens
+
+    def record(self, prompt_tokens: int, completion_tokens: int, cost: float = 0.0) -> None:
+        with self.lock:
+            self.prompt_tokens += prompt_tokens
+            self.completion_tokens += completion_tokens
+            self.cost += cost
+        if self.parent is not None:
+            self.parent.record(prompt_tokens, completion_tokens, cost)
+
+    def snapshot(self) -> Dict[str, float]:
+        with self.lock:
+            return {
+                "prompt_tokens": self.prompt_tokens,
+                "completion_tokens": self.completion_tokens,
+                "total_tokens": self.total_tokens,
+                "cost": round(self.cost, 6),
+                "elapsed": round(time.time() - self.started, 3),
+            }
+
+
+@dataclass(frozen=True)
+class Budget:
+    deadline_seconds: Optional[float] = None
+    max_tokens: Optional[int] = None
+    max_cost: Optional[float] = None
+
+    @classmethod
+    def from_env(cls, prefix: str) -> "Budget":
+        def _read(name: str, cast):
+            value = os.getenv(f"{prefix}_{name}")
+            return cast(value) if value not in (None, "", "0") else None
+
+        return cls(
+            deadline_seconds=_read("DEADLINE_S", float),
+            max_tokens=_read("MAX_TOKENS", int),
+            max_cost=_read("MAX_COST", float),
+        )
+
+    def as_dict(self) -> Dict[str, Optional[float]]:
+        return {"deadline_seconds": self.deadline_seconds, "max_tokens": self.max_tokens, "max_cost": self.max_cost}
+
+
+def exhausted_reason(budget: Budget, meter: UsageMeter, reserve: float) -> Optional[str]:
+    """Return why a budget is nearly used up (within ``reserve`` fraction of any limit), else None."""
+    usage = meter.snapshot()
+    threshold = 1.0 - reserve
+    if budget.deadline_seconds and usage["elapsed"] >= threshold * budget.deadline_seconds:
+        return f"deadline ({usage['elapsed']:.0f}s of {budget.deadline_seconds:.0f}s)"
+    if budget.max_tokens and usage["total_tokens"] >= threshold * budget.max_tokens:
+        return f"tokens ({usage['total_tokens']} of {budget.max_tokens})"
+    if budget.max_cost and usage["cost"] >= threshold * budget.max_cost:
+        return f"cost (${usage['cost']:.4f} of ${budget.max_cost:.4f})"
+    return None
+
+
+_meters: Dict[str, UsageMeter] = {}
+_meters_lock = threading.Lock()
+_batch_meter: Optional[UsageMeter] = None
+
+
+def batch_meter() -> UsageMeter:
+    """Process-wide meter shared by every song run in this process (per-batch budget)."""
+    global _batch_meter
+    with _meters_lock:
+        if _batch_meter is None:
+            _batch_meter = UsageMeter()
+        return _batch_meter
+
+
+def start_run(run_id: str) -> UsageMeter:
+    meter = UsageMeter(parent=batch_meter())
+    with _meters_lock:
+        _meters[run_id] = meter
+    return meter
+
+
+def active_runs() -> int:
+    """Number of song runs currently in progress in this process."""
+    with _meters_lock:
+        return len(_meters)
+
+
+def run_meter(run_id: str) -> Optional[UsageMeter]:
+    return _meters.get(run_id)
+
+
+def finish_run(run_id: str) -> None:
+    with _meters_lock:
+        _meters.pop(run_id, None)
+
+
+def activate_meter(meter: Optional[UsageMeter]):
+    """Route usage recorded in this context (and contexts copied from it) to ``meter``."""
+    return _current_meter.set(meter)
+
+
+def deactivate_meter(token) -> None:
+    _current_meter.reset(token)
+
+
+def share_usage(meter: UsageMeter, contexts: List[Context]) -> None:
+    """Split usage collected on ``meter`` evenly across the meters active in each of ``contexts``."""
+    if not contexts:
+        return
+    usage = meter.snapshot()
+    prompt_share, prompt_rest = divmod(int(usage["prompt_tokens"]), len(contexts))
+    completion_share, completion_rest = divmod(int(usage["completion_tokens"]), len(contexts))
+    for index, context in enumerate(contexts):
+        target = context.get(_current_meter)
+        if target is not None:
+            # The first caller absorbs the rounding remainder so totals still add up.
+            target.record(
+                prompt_share + (prompt_rest if index == 0 else 0),
+                completion_share + (completion_rest if index == 0 else 0),
+                usage["cost"] / len(contexts),
+            )
+
+
+def record_usage(response: Any = None, prompt: str = "", output: str = "", cost: float = 0.0) -> None:
+    """Record an LLM call against the active meter, estimating tokens when the response has no usage."""
+    meter = _current_meter.get()
+    if meter is None:
+        return
+    usage = getattr(response, "usage", None)
+    prompt_tokens = getattr(usage, "prompt_tokens", None)
+    completion_tokens = getattr(usage, "completion_tokens", None)
+    if prompt_tokens is None or completion_tokens is None:
+        from prompt_sizing import count_tokens
+
+        if prompt_tokens is None:
+            prompt_tokens = count_tokens(prompt)
+        if completion_tokens is None:
+            completion_tokens = count_tokens(output)
+    meter.record(int(prompt_tokens), int(completion_tokens), cost)
+
+
+def budget_exhausted(state: Dict[str, Any]) -> Optional[str]:
+    """Check the song's budget from state and the process-wide batch budget."""
+    reserve = float(os.getenv("BUDGET_RESERVE", "0.15"))
+    meter = run_meter(state.get("run_id", ""))
+    song_budget = Budget(**state.get("budget", {}))
+    if meter is not None:
+        reason = exhausted_reason(song_budget, meter, reserve)
+        if reason:
+            return f"song {reason}"
+    reason = exhausted_reason(Budget.from_env("BATCH"), batch_meter(), reserve)
+    return f"batch {reason}" if reason else None
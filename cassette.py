@@ -0,0 +1,118 @@
+import base64
+import hashlib
+import json
+import os
+import threading
+import time
+from typing import Any, Callable, Dict, List, Optional
+
+CASSETTE_VERSION = 1
+
+
+class CassetteMiss(KeyError):
+    """Raised in replay mode when a request was never recorded."""
+
+
+class Cassette:
+    """Records LLM and image requests/responses to a JSON file, or serves them back offline.
+
+    Entries are keyed by stage plus a hash of the full request, and each key holds the responses in
+    the order they were recorded so repeated identical requests replay in sequence.
+    """
+
+    def __init__(self, path: str, mode: str, latency: Optional[str] = None):
+        if mode not in ("record", "replay"):
+            raise ValueError(f"Unknown cassette mode: {mode}")
+        self.path = path
+        self.mode = mode
+        self.latency = latency
+        self.entries: Dict[str, List[Dict[str, Any]]] = {}
+        self.cursors: Dict[str, int] = {}
+        self.lock = threading.Lock()
+        if mode == "replay":
+            if not os.path.isfile(path):
+                raise FileNotFoundError(f"Cassette not found: {path}")
+            with open(path, "r") as file:
+                data = json.load(file)
+            self.entries = data.get("entries", {})
+
+    @staticmethod
+    def key(stage: str, *parts: Optional[str]) -> str:
+        digest = hashlib.sha256("\x00".join(part or "" for part in parts).encode("utf-8")).hexdigest()[:24]
+        return f"{stage}:{digest}"
+
+    def _simulated_delay(self, recorded: float) -> float:
+        if not self.latency:
+            return 0.0
+        if self.latency == "recorded":
+            return recorded
+        return float(self.latency)
+
+    def _replay(self, key: str) -> Dict[str, Any]:
+        with self.lock:
+            recorded = self.entries.get(key)
+            if not recorded:
+                raise CassetteMiss(f"No recorded response for {key}")
+            index = self.cursors.get(key, 0)
+            self.cursors[key] = index + 1
+        entry = recorded[min(index, len(recorded) - 1)]
+        delay = self._simulated_delay(float(entry.get("latency", 0.0)))
+        if delay > 0:
+            time.sleep(delay)
+        return entry
+
+    def _record(self, key: str, entry: Dict[str, Any]) -> None:
+        with self.lock:
+            self.entries.setdefault(key, []).append(entry)
+
+    def text(self, stage: str, system: Optional[str], prompt: str, call: Callable[[], str]) -> str:
+        """Serve a text completion from the cassette, or perform and record it."""
+        key = self.key(stage, system, prompt)
+        if self.mode == "replay":
+            return self._replay(key)["response"]
+        started = time.monotonic()
+        response = call()
+        self._record(key, {"stage": stage, "response": response, "latency": round(time.monotonic() - started, 3)})
+        return response
+
+    def image(self, stage: str, prompt: str, output_file: str, call: Callable[[], None]) -> None:
+        """Write a recorded image to ``output_file``, or generate it and record its bytes."""
+        key = self.key(stage, prompt)
+        if self.mode == "replay":
+            entry = self._replay(key)
+            tmp_path = f"{output_file}.{os.getpid()}.{threading.get_ident()}.tmp"
+            with open(tmp_path, "wb") as file:
+                file.write(base64.b64decode(entry["image"]))
+            os.replace(tmp_path, output_file)
+            return
+        started = time.monotonic()
+        call()
+        with open(output_file, "rb") as file:
+            image = base64.b64encode(file.read()).decode("ascii")
+        self._record(key, {"stage": stage, "image": image, "latency": round(time.monotonic() - started, 3)})
+
+    def save(self) -> None:
+        if self.mode != "record":
+            return
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with self.lock:
+            payload = {"version": CASSETTE_VERSION, "entries": self.entries}
+        tmp_path = f"{self.path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w") as file:
+            json.dump(payload, file, indent=1)
+        os.replace(tmp_path, self.path)
+
+
+_active: Optional[Cassette] = None
+
+
+def use_cassette(cassette: Optional[Cassette]) -> None:
+    """Activate a cassette for every LLM and image request made by this process."""
+    global _active
+    _active = cassette
+
+
+def active_cassette() -> Optional[Cassette]:
+    return _active
@@ -0,0 +1,162 @@
+import json
+import os
+import threading
+import time
+import urllib.request
+from dataclasses import asdict, dataclass, field
+from typing import Any, Dict, List, Optional
+
+DEFAULT_CACHE_PATH = os.path.join(".cache", "endpoint_capabilities.json")
+
+_cache_lock = threading.Lock()
+
+
+@dataclass
+class EndpointCapabilities:
+    """What an OpenAI-compatible local server supports, probed once and cached per base URL."""
+    base_url: str
+    model: str
+    chat: bool = False
+    completions: bool = False
+    json_mode: bool = False
+    n: bool = False
+    streaming: bool = False
+    context_length: Optional[int] = None
+    loaded_models: List[str] = field(default_factory=list)
+    probed_at: float = 0.0
+
+    @property
+    def endpoint(self) -> Optional[str]:
+        if self.chat:
+            return "chat"
+        if self.completions:
+            return "completions"
+        return None
+
+
+def _cache_path() -> str:
+    return os.getenv("LMSTUDIO_CAPABILITIES_CACHE", DEFAULT_CACHE_PATH)
+
+
+def _cache_key(base_url: str, model: str) -> str:
+    return f"{base_url.rstrip('/')}|{model}"
+
+
+def _read_cache() -> Dict[str, Dict[str, Any]]:
+    path = _cache_path()
+    if not os.path.isfile(path):
+        return {}
+    try:
+        with open(path, "r") as file:
+            data = json.load(file)
+    except (OSError, ValueError):
+        return {}
+    return data if isinstance(data, dict) else {}
+
+
+def _write_cache(data: Dict[str, Dict[str, Any]]) -> None:
+    path = _cache_path()
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "w") as file:
+        json.dump(data, file, indent=2, sort_keys=True)
+    os.replace(tmp_path, path)
+
+
+def _succeeds(call) -> bool:
+    try:
+        return bool(call())
+    except Exception:
+        return False
+
+
+def _fetch_model_info(base_url: str, model: str, api_key: str, timeout: float) -> Dict[str, Any]:
+    """Read loaded models and context length from LM Studio's REST API, if the server exposes it."""
+    root = base_url.rstrip("/")
+    if root.endswith("/v1"):
+        root = root[: -len("/v1")]
+    request = urllib.request.Request(f"{root}/api/v0/models", headers={"Authorization": f"Bearer {api_key}"})
+    try:
+        with urllib.request.urlopen(request, timeout=timeout) as response:
+            payload = json.load(response)
+    except Exception:
+        return {}
+
+    entries = payload.get("data", []) if isinstance(payload, dict) else []
+    loaded = [entry.get("id") for entry in entries if entry.get("state") == "loaded" and entry.get("id")]
+    # LM Studio serves whichever model is loaded when the configured id is unknown
+    target = model if any(entry.get("id") == model for entry in entries) else (loaded[0] if loaded else None)
+    context_length = None
+    for entry in entries:
+        if entry.get("id") == target:
+            context_length = entry.get("loaded_context_length") or entry.get("max_context_length")
+            break
+    return {"loaded_models": loaded, "context_length": context_length}
+
+
+def probe_capabilities(client, base_url: str, model: str, api_key: str = "lm-studio") -> EndpointCapabilities:
+    """Issue a handful of 1-token requests to find out which features the server supports."""
+    timeout = float(os.getenv("LMSTUDIO_PROBE_TIMEOUT", "30"))
+    probe_client = client.with_options(timeout=timeout, max_retries=0)
+    messages = [{"role": "user", "content": "Reply with {}"}]
+    caps = EndpointCapabilities(base_url=base_url, model=model, probed_at=time.time())
+
+    caps.chat = _succeeds(lambda: probe_client.chat.completions.create(model=model, messages=messages, max_tokens=1).choices)
+    if caps.chat:
+        caps.json_mode = _succeeds(
+            lambda: probe_client.chat.completions.create(
+                model=model, messages=messages, max_tokens=1, response_format={"type": "json_object"}
+            ).choices
+        )
+        caps.n = _succeeds(
+            lambda: len(probe_client.chat.completions.create(model=model, messages=messages, max_tokens=1, n=2).choices) == 2
+        )
+        caps.streaming = _succeeds(
+            lambda: list(probe_client.chat.completions.create(model=model, messages=messages, max_tokens=1, stream=True))
+        )
+    else:
+        caps.completions = _succeeds(lambda: probe_client.completions.create(model=model, prompt="Reply with {}", max_tokens=1).choices)
+        if caps.completions:
+            caps.n = _succeeds(
+                lambda: len(probe_client.completions.create(model=model, prompt="Reply with {}", max_tokens=1, n=2).choices) == 2
+            )
+            caps.streaming = _succeeds(
+                lambda: list(probe_client.completions.create(model=model, prompt="Reply with {}", max_tokens=1, stream=True))
+            )
+
+    info = _fetch_model_info(base_url, model, api_key, timeout)
+    caps.loaded_models = info.get("loaded_models", [])
+    caps.context_length = info.get("context_length")
+    return caps
+
+
+def load_capabilities(client, base_url: str, model: str, api_key: str = "lm-studio") -> EndpointCapabilities:
+    """Return cached capabilities for this endpoint, probing and persisting them when missing or stale."""
+    ttl = float(os.getenv("LMSTUDIO_CAPABILITIES_TTL", "86400"))
+    key = _cache_key(base_url, model)
+    with _cache_lock:
+        cached = _read_cache().get(key)
+    if cached and time.time() - float(cached.get("probed_at", 0)) < ttl:
+        try:
+            return EndpointCapabilities(**cached)
+        except TypeError:
+            pass
+
+    caps = probe_capabilities(client, base_url, model, api_key)
+    # An unreachable server is not a capability; probe again next time instead of caching it.
+    if caps.endpoint is not None:
+        with _cache_lock:
+            data = _read_cache()
+            data[key] = asdict(caps)
+            _write_cache(data)
+    return caps
+
+
+def invalidate_capabilities(base_url: str, model: str) -> None:
+    key = _cache_key(base_url, model)
+    with _cache_lock:
+        data = _read_cache()
+        if data.pop(key, None) is not None:
+            _write_cache(data)
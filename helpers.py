@@ -1,8 +1,18 @@
+import glob
+import hashlib
 import json
 import os
+import re
+import tempfile
+import threading
+import uuid
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass
 from datetime import datetime
-from typing import Any, Dict, List, Optional, TypedDict
+from types import MappingProxyType
+from typing import Any, Dict, List, Mapping, Optional, Tuple, TypedDict
+
+from tqdm import tqdm
 
 from tools.create_album_art import generate_album_art_image
 
@@ -27,13 +37,22 @@ def read_styles() -> Dict[str, str]:
 
 def read_tags() -> Dict[str, str]:
     tags: Dict[str, str] = {}
-    for filename in os.listdir("tags"):
+    for filename in sorted(os.listdir("tags")):
         if filename.endswith(".txt"):
             with open(f"tags/{filename}", "r") as file:
                 tags[filename] = file.read()
     return tags
 
 
+def render_resources(resources: Mapping[str, str]) -> str:
+    """Render styles/tags deterministically (sorted keys, raw values) so prompt prefixes stay cacheable."""
+    return "\n\n".join(f"[{key}]\n{resources[key]}" for key in sorted(resources))
+
+
+def render_params(params: Mapping[str, Any]) -> str:
+    return json.dumps(dict(params), sort_keys=True, ensure_ascii=False)
+
+
 def read_persona(persona_name: str) -> str:
     persona_file = resolve_persona_file(persona_name)
     if not persona_file:
@@ -128,16 +147,84 @@ def extract_title(lyrics: str, provided_title: Optional[str]) -> str:
     return "Unknown Song"
 
 
-def generate_album_art(title: str, user_input: str) -> str:
+def atomic_write(path: str, data: Any) -> None:
+    """Write text or bytes to ``path`` via a temp file in the same directory and an atomic rename."""
+    directory = os.path.dirname(path) or "."
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=f".{os.path.basename(path)}.", suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb" if isinstance(data, bytes) else "w") as file:
+            file.write(data)
+            file.flush()
+            os.fsync(file.fileno())
+        # mkstemp creates 0600 files; keep songs readable like a plain open() would.
+        os.chmod(tmp_path, 0o644)
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def update_alias(alias: str, target: str) -> bool:
+    """Atomically point the symlink ``alias`` at ``target``.
+
+    Never replaces a regular file (songs saved before run-ID naming keep their plain names), and
+    returns False where symlinks are unavailable.
+    """
+    if os.path.exists(alias) and not os.path.islink(alias):
+        return False
+    tmp_path = f"{alias}.{os.getpid()}.{threading.get_ident()}.tmp"
+    try:
+        os.symlink(os.path.relpath(target, os.path.dirname(alias) or "."), tmp_path)
+        os.replace(tmp_path, alias)
+    except OSError:
+        if os.path.lexists(tmp_path):
+            os.remove(tmp_path)
+        return False
+    return True
+
+
+def sidecar_path_for(song_path: str) -> str:
+    return f"{os.path.splitext(song_path)[0]}.json"
+
+
+def load_song_record(song_path: str) -> Optional[Dict[str, Any]]:
+    """Return the JSON sidecar written next to a song by ``save_song``, or None for older songs."""
+    path = sidecar_path_for(os.path.expanduser(song_path))
+    if not os.path.isfile(path):
+        return None
+    with open(path, "r") as file:
+        return json.load(file)
+
+
+def cover_path_for(title: str, run_id: Optional[str] = None) -> str:
+    """Cover location for a song; run-specific when ``run_id`` is given, else the stable alias."""
+    suffix = f"_{run_id}" if run_id else ""
+    return f"songs/{title.replace(' ', '_')}{suffix}_cover.jpg"
+
+
+def generate_album_art(title: str, user_input: str, use_cache: bool = True, run_id: Optional[str] = None) -> str:
     """Generate album artwork using integrated function."""
     artwork_prompt = (
         f"Album cover for song '{title}' with theme {user_input}. "
         "Do not include any text, lettering, or typography on the image."
     )
-    output_file = f"songs/{title.replace(' ', '_')}_cover.jpg"
+    output_file = cover_path_for(title, run_id)
     os.makedirs("songs", exist_ok=True)
     try:
-        generate_album_art_image(artwork_prompt, output_file)
+        from cassette import active_cassette
+
+        cassette = active_cassette()
+        if cassette is None:
+            generate_album_art_image(artwork_prompt, output_file, use_cache=use_cache)
+        else:
+            cassette.image(
+                "album_art",
+                artwork_prompt,
+                output_file,
+                call=lambda: generate_album_art_image(artwork_prompt, output_file, use_cache=use_cache),
+            )
     except Exception as e:
         print(f"Warning: Failed to generate album art: {e}")
         return None
@@ -175,6 +262,254 @@ def extract_song_details_for_art(song_path: str) -> tuple[str, str]:
     return title, user_prompt
 
 
+_METADATA_LINE_RE = re.compile(r"^- \*\*(.+?)\*\*:\s?(.*)$")
+
+
+def _split_style_line(line: str) -> List[str]:
+    line = line.strip()
+    if not line or line == "None":
+        return []
+    return [token.strip() for token in line.split(",") if token.strip()]
+
+
+def parse_song_markdown(content: str) -> Dict[str, Any]:
+    """Parse a song file written by ``save_song`` in a single pass over its lines.
+
+    Returns title, description, suno_styles, suno_exclude_styles, the Additional Metadata
+    entries (snake_cased keys such as target_audience and user_prompt) and the lyrics.
+    Metadata values are collapsed onto one line, except user_prompt which keeps its newlines.
+    """
+    song: Dict[str, Any] = {"title": None, "description": "", "suno_styles": [], "suno_exclude_styles": [], "lyrics": ""}
+    section = None
+    metadata_key = None
+    block: List[str] = []
+    lines = content.splitlines()
+    for index, line in enumerate(lines):
+        if line.startswith("### Song Lyrics"):
+            song["lyrics"] = "\n".join(lines[index + 1:]).strip("\n")
+            break
+        if line.startswith("## Suno Styles"):
+            section = "styles"
+        elif line.startswith("## Suno Exclude-styles"):
+            section = "exclude"
+        elif line.startswith("## Additional Metadata"):
+            section = "metadata"
+        elif song["title"] is None and line.startswith("## "):
+            song["title"] = line[3:].strip()
+            section = "header"
+        elif section == "header" and line.startswith("### ") and not song["description"]:
+            song["description"] = line[4:].strip()
+        elif section == "styles" and line.strip():
+            song["suno_styles"] = _split_style_line(line)
+        elif section == "exclude" and line.strip():
+            song["suno_exclude_styles"] = _split_style_line(line)
+        elif section == "metadata":
+            match = _METADATA_LINE_RE.match(line)
+            if match:
+                if metadata_key:
+                    song[metadata_key] = _metadata_value(metadata_key, block)
+                metadata_key = match.group(1).strip().lower().replace(" ", "_")
+                block = [match.group(2)]
+            elif metadata_key:
+                # Multi-line values (usually the user prompt) continue until the next entry
+                block.append(line)
+    if metadata_key:
+        song[metadata_key] = _metadata_value(metadata_key, block)
+    return song
+
+
+def _metadata_value(key: str, block: List[str]) -> str:
+    # The user prompt is fed back to the drafter on re-runs, so its line breaks are kept.
+    if key == "user_prompt":
+        return "\n".join(block).strip()
+    return " ".join(" ".join(block).split())
+
+
+def load_song_state(song_path: str) -> Dict[str, Any]:
+    """Rebuild the graph state fields of a saved song (title, lyrics, user prompt, metadata).
+
+    The markdown is authoritative so hand edits are picked up; the JSON sidecar, when present,
+    only supplies what markdown does not carry (persona, score history, current cover).
+    """
+    expanded = os.path.expanduser(song_path)
+    if not os.path.isfile(expanded):
+        raise FileNotFoundError(f"Song file not found: {song_path}")
+    with open(expanded, "r") as file:
+        song = parse_song_markdown(file.read())
+    if not song["title"] or not song["lyrics"]:
+        raise ValueError(f"Could not parse title and lyrics from {song_path}")
+
+    state: Dict[str, Any] = {
+        "user_input": song.get("user_prompt", ""),
+        "song_name": song["title"],
+        "lyrics": song["lyrics"],
+        "metadata": {
+            key: song[key]
+            for key in ("description", "suno_styles", "suno_exclude_styles", "target_audience", "commercial_potential")
+            if song.get(key)
+        },
+    }
+    record = load_song_record(expanded)
+    if record:
+        for key in ("persona_name", "score", "score_history", "album_art"):
+            if record.get(key) is not None:
+                state[key] = record[key]
+    return state
+
+
+def expand_song_paths(target: str) -> List[str]:
+    """Expand a song file, a directory of songs, or a glob pattern into sorted markdown paths.
+
+    Stable-name aliases are skipped when expanding so each song run is visited once.
+    """
+    expanded = os.path.expanduser(target)
+    if os.path.isdir(expanded):
+        return sorted(path for path in glob.glob(os.path.join(expanded, "*.md")) if not os.path.islink(path))
+    if glob.has_magic(expanded):
+        return sorted(
+            path for path in glob.glob(expanded, recursive=True) if os.path.isfile(path) and not os.path.islink(path)
+        )
+    return [expanded]
+
+
+def regenerate_covers(song_paths: List[str], workers: int = 4, force: bool = False) -> List[Tuple[str, Optional[str], str]]:
+    """Regenerate covers for many songs concurrently.
+
+    Songs whose cover is newer than the song file are skipped unless ``force`` is set; ``force``
+    also bypasses the image cache. Returns ``(song_path, cover_path, status)`` per song.
+    """
+    def _regen(song_path: str) -> Tuple[str, Optional[str], str]:
+        try:
+            title, user_prompt = extract_song_details_for_art(song_path)
+        except (FileNotFoundError, ValueError) as err:
+            return song_path, None, f"error: {err}"
+        record = load_song_record(song_path)
+        run_id = record.get("run_id") if record else None
+        cover_path = cover_path_for(title, run_id)
+        if not force and os.path.isfile(cover_path) and os.path.getmtime(cover_path) >= os.path.getmtime(song_path):
+            return song_path, cover_path, "up to date"
+        artwork_path = generate_album_art(
+            title,
+            user_prompt or "Use the song metadata to inspire the cover art.",
+            use_cache=not force,
+            run_id=run_id,
+        )
+        return song_path, artwork_path, "generated" if artwork_path else "failed"
+
+    results: List[Tuple[str, Optional[str], str]] = []
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+        for result in tqdm(executor.map(_regen, song_paths), total=len(song_paths), desc="Regenerating covers", unit="song"):
+            results.append(result)
+    return results
+
+
+_BULLET_RE = re.compile(r"^\s*(?:[-*\u2022]|\d+[.)])\s+")
+_SECTION_RE = re.compile(r"^\s*\[([^\]]+)\]", re.MULTILINE)
+_WORD_RE = re.compile(r"[a-z0-9']+")
+
+
+def split_feedback_items(feedback: str) -> List[str]:
+    """Split free-form reviewer feedback into individual suggestions (bullets or paragraphs)."""
+    items: List[str] = []
+    current: List[str] = []
+
+    def _flush():
+        text = " ".join(" ".join(current).split())
+        if len(text.split()) >= 4:
+            items.append(text)
+        current.clear()
+
+    for line in feedback.splitlines():
+        stripped = line.replace("**", "").strip()
+        if not stripped:
+            _flush()
+            continue
+        if _BULLET_RE.match(stripped):
+            _flush()
+            stripped = _BULLET_RE.sub("", stripped)
+        elif stripped.startswith("#") or (stripped.endswith(":") and len(stripped.split()) <= 4):
+            # Headings such as "Strengths:" introduce items rather than being suggestions.
+            _flush()
+            continue
+        current.append(stripped)
+    _flush()
+    return items
+
+
+def _shingles(text: str, size: int = 2) -> set:
+    words = _WORD_RE.findall(text.lower())
+    if len(words) < size:
+        return {" ".join(words)}
+    return {" ".join(words[idx:idx + size]) for idx in range(len(words) - size + 1)}
+
+
+def lyric_sections(lyrics: str) -> List[str]:
+    """Section names in order of appearance, e.g. ["Verse 1", "Chorus", "Bridge"]."""
+    return list(dict.fromkeys(match.strip() for match in _SECTION_RE.findall(lyrics) if match.strip()))
+
+
+def section_for(text: str, sections: List[str]) -> str:
+    """The lyric section a suggestion is about: the one named earliest in ``text``, longest name on ties.
+
+    Names match on word boundaries, so "Verse 1" beats "Verse" and "Pre-Chorus" beats "Chorus".
+    """
+    best = None
+    for name in sections:
+        pattern = r"(?<!\w)" + r"\s+".join(re.escape(word) for word in name.split()) + r"(?!\w)"
+        match = re.search(pattern, text, re.IGNORECASE)
+        if match and (best is None or (match.start(), -len(name)) < best[0]):
+            best = ((match.start(), -len(name)), name)
+    return best[1] if best else "General"
+
+
+def consolidate_feedback(feedbacks: List[str], lyrics: str, token_budget: int = 600, similarity: float = 0.5) -> str:
+    """Merge reviewers' feedback into a compact, de-duplicated list grouped by lyric section.
+
+    Near-identical suggestions (Jaccard similarity of word-bigram shingles of at least ``similarity``) are
+    merged and ranked by how many reviewers raised them. When the output would exceed ``token_budget``
+    tokens (section headers included), the least-shared suggestions are dropped first.
+    """
+    from prompt_sizing import count_tokens
+
+    merged: List[Dict[str, Any]] = []
+    for reviewer, feedback in enumerate(feedbacks):
+        for text in split_feedback_items(feedback or ""):
+            shingles = _shingles(text)
+            for entry in merged:
+                union = shingles | entry["shingles"]
+                if union and len(shingles & entry["shingles"]) / len(union) >= similarity:
+                    entry["reviewers"].add(reviewer)
+                    break
+            else:
+                merged.append({"text": text, "shingles": shingles, "reviewers": {reviewer}})
+
+    sections = lyric_sections(lyrics)
+
+    def _header(section: str) -> str:
+        return f"[{section}]" if section != "General" else "General"
+
+    # Pick the most widely shared suggestions first, then present the survivors grouped by section.
+    total = len(feedbacks)
+    grouped: Dict[str, List[str]] = {}
+    used = 0
+    for entry in sorted(merged, key=lambda item: -len(item["reviewers"])):
+        section = section_for(entry["text"], sections)
+        line = f"- ({len(entry['reviewers'])}/{total}) {entry['text']}"
+        cost = count_tokens(line) + 1
+        if section not in grouped:
+            cost += count_tokens(_header(section)) + 1
+        if used + cost > token_budget:
+            continue
+        grouped.setdefault(section, []).append(line)
+        used += cost
+
+    lines: List[str] = []
+    for section in [name for name in sections if name in grouped] + (["General"] if "General" in grouped else []):
+        lines.append(_header(section))
+        lines.extend(grouped[section])
+    return "\n".join(lines)
+
+
 def parse_persona_styles_list(persona_styles: str):
     if not persona_styles:
         return []
@@ -185,8 +520,23 @@ def parse_persona_styles_list(persona_styles: str):
     return [token for token in raw_tokens if token]
 
 
-def save_song(title: str, user_input: str, lyrics: str, default_params: Dict[str, Optional[str]], metadata: Dict[str, object]) -> str:
-    """Save the generated song to a markdown file with metadata."""
+def save_song(
+    title: str,
+    user_input: str,
+    lyrics: str,
+    default_params: Dict[str, Optional[str]],
+    metadata: Dict[str, object],
+    notes: Optional[List[str]] = None,
+    run_id: Optional[str] = None,
+    album_art: Optional[str] = None,
+    record: Optional[Dict[str, Any]] = None,
+) -> str:
+    """Save the generated song to a markdown file with metadata.
+
+    Files are named ``songs/{date}_{Title}_{run_id}.md`` and written atomically, so concurrent runs
+    never clobber each other. A JSON sidecar holds ``record`` (the run's final outputs), and
+    ``songs/{date}_{Title}.md``/``.json`` plus ``{Title}_cover.jpg`` are symlinked to the latest run.
+    """
     description = metadata.get("description", "Short description of the song's theme and style.")
     suno_styles = metadata.get("suno_styles", [default_params.get("genre", "rock")])
     suno_exclude_styles = metadata.get("suno_exclude_styles", [])
@@ -194,6 +544,7 @@ def save_song(title: str, user_input: str, lyrics: str, default_params: Dict[str
     exclude_line = ", ".join(suno_exclude_styles) if isinstance(suno_exclude_styles, list) else str(suno_exclude_styles)
     target_audience = metadata.get("target_audience", "Suggested demographic")
     commercial_potential = metadata.get("commercial_potential", "Assessment")
+    notes_line = f"\n- **Budget Notes**: {'; '.join(notes)}" if notes else ""
 
     final_md = f"""
 ## {title}
@@ -209,26 +560,55 @@ def save_song(title: str, user_input: str, lyrics: str, default_params: Dict[str
 - **Emotional Arc**: {default_params['mood']}
 - **Target Audience**: {target_audience}
 - **Commercial Potential**: {commercial_potential}
-- **Technical Notes**: BPM: {default_params['tempo']}, Key: {default_params['key']}, Instruments: {default_params['instruments']}
+- **Technical Notes**: BPM: {default_params['tempo']}, Key: {default_params['key']}, Instruments: {default_params['instruments']}{notes_line}
 - **User Prompt**: {user_input}
 
 ### Song Lyrics:
 {lyrics}
 """
     os.makedirs("songs", exist_ok=True)
-    date = datetime.now().strftime("%Y%m%d")
-    filename = f"songs/{date}_{title.replace(' ', '_')}.md"
-    with open(filename, "w") as file:
-        file.write(final_md)
+    run_id = run_id or uuid.uuid4().hex[:12]
+    now = datetime.now()
+    stem = f"songs/{now.strftime('%Y%m%d')}_{title.replace(' ', '_')}"
+    filename = f"{stem}_{run_id}.md"
+    sidecar = {
+        **(record or {}),
+        "run_id": run_id,
+        "title": title,
+        "filename": filename,
+        "album_art": album_art,
+        "saved_at": now.isoformat(timespec="seconds"),
+        "user_input": user_input,
+        "lyrics": lyrics,
+        "metadata": metadata,
+        "default_params": dict(default_params),
+        "notes": list(notes or []),
+    }
+    # Sidecar first: once the markdown appears, readers can rely on its sidecar existing.
+    atomic_write(sidecar_path_for(filename), json.dumps(sidecar, indent=2, ensure_ascii=False, default=str))
+    atomic_write(filename, final_md)
+    update_alias(f"{stem}.md", filename)
+    update_alias(f"{stem}.json", sidecar_path_for(filename))
+    if album_art:
+        update_alias(cover_path_for(title), album_art)
     return filename
 
 
-@dataclass
+@dataclass(frozen=True)
 class SongResources:
-    styles: Dict[str, str]
-    tags: Dict[str, str]
+    styles: Mapping[str, str]
+    tags: Mapping[str, str]
     persona_styles: str
-    default_params: Dict[str, Optional[str]]
+    default_params: Mapping[str, Optional[str]]
+
+    @property
+    def version(self) -> str:
+        """Content hash identifying this resource set; identical resources share one key."""
+        payload = json.dumps(
+            [dict(self.styles), dict(self.tags), self.persona_styles, dict(self.default_params)],
+            sort_keys=True,
+        )
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()[:16]
 
 
 class SongState(TypedDict, total=False):
@@ -237,10 +617,12 @@ class SongState(TypedDict, total=False):
     persona: Optional[str]
     persona_name: Optional[str]
     use_local: bool
-    resources: SongResources
+    run_id: str
+    resources_key: str
     lyrics: str
     feedback: str
     score: float
+    score_history: List[float]
     round: int
     max_rounds: int
     score_threshold: float
@@ -249,6 +631,11 @@ class SongState(TypedDict, total=False):
     metadata: Dict[str, Any]
     filename: Optional[str]
     album_art: Optional[str]
+    budget: Dict[str, Optional[float]]
+    usage: Dict[str, float]
+    budget_exhausted: Optional[str]
+    budget_decisions: List[str]
+    timings: Dict[str, float]
 
 
 def load_resources(persona_name: Optional[str]) -> SongResources:
@@ -256,7 +643,50 @@ def load_resources(persona_name: Optional[str]) -> SongResources:
     tags = read_tags()
     persona_styles = read_persona(persona_name) if persona_name else ""
     default_params = get_default_song_params()
-    return SongResources(styles=styles, tags=tags, persona_styles=persona_styles, default_params=default_params)
+    return SongResources(
+        styles=MappingProxyType(styles),
+        tags=MappingProxyType(tags),
+        persona_styles=persona_styles,
+        default_params=MappingProxyType(default_params),
+    )
+
+
+# Process-level registry so graph state only carries a short key instead of ~120 KB of
+# styles/tags that LangGraph would otherwise copy on every node transition.
+_resource_registry: Dict[str, SongResources] = {}
+_persona_resource_keys: Dict[Optional[str], str] = {}
+_resource_lock = threading.Lock()
+
+
+def register_resources(resources: SongResources) -> str:
+    key = resources.version
+    with _resource_lock:
+        _resource_registry.setdefault(key, resources)
+    return key
+
+
+def get_resources(key: str) -> SongResources:
+    try:
+        return _resource_registry[key]
+    except KeyError:
+        raise KeyError(f"Unknown resources key: {key}") from None
+
+
+def acquire_resources(persona_name: Optional[str]) -> str:
+    """Load resources for a persona once per process and return their registry key."""
+    with _resource_lock:
+        key = _persona_resource_keys.get(persona_name)
+    if key is not None:
+        return key
+    key = register_resources(load_resources(persona_name))
+    with _resource_lock:
+        _persona_resource_keys[persona_name] = key
+    return key
+
+
+def state_payload_size(state: Dict[str, Any]) -> int:
+    """Approximate serialized size of a graph state in bytes."""
+    return len(json.dumps(state, default=str).encode("utf-8"))
 
 
 def progress_steps(use_local: bool):
@@ -0,0 +1,379 @@
+import json
+import os
+import socket
+import sqlite3
+import sys
+import threading
+import time
+from abc import ABC, abstractmethod
+from dataclasses import dataclass
+from typing import Any, Callable, Dict, List, Optional
+
+
+@dataclass
+class Job:
+    id: int
+    payload: Dict[str, Any]
+    attempts: int
+
+
+class JobQueue(ABC):
+    """Leased job queue with at-least-once semantics.
+
+    A worker leases a job for ``lease_seconds`` and must heartbeat to keep it; jobs whose lease
+    expires (crashed or partitioned worker) become leasable again.
+    """
+
+    @abstractmethod
+    def enqueue(self, payload: Dict[str, Any]) -> int:
+        ...
+
+    @abstractmethod
+    def lease(self, worker_id: str, lease_seconds: float, max_attempts: int = 3) -> Optional[Job]:
+        """Lease the oldest available job.
+
+        An expired lease whose job has already been attempted ``max_attempts`` times (its worker
+        died without reporting) is marked failed instead of being handed out again.
+        """
+
+    @abstractmethod
+    def heartbeat(self, job_id: int, worker_id: str, lease_seconds: float) -> bool:
+        ...
+
+    @abstractmethod
+    def complete(self, job_id: int, worker_id: str, result: Dict[str, Any]) -> bool:
+        ...
+
+    @abstractmethod
+    def fail(self, job_id: int, worker_id: str, error: str, max_attempts: int) -> bool:
+        ...
+
+    @abstractmethod
+    def counts(self) -> Dict[str, int]:
+        ...
+
+
+class SQLiteJobQueue(JobQueue):
+    """Job queue stored in a SQLite file, usable from several hosts on a shared filesystem."""
+
+    def __init__(self, path: str, timeout: float = 30.0):
+        self.path = path
+        self.timeout = timeout
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        conn = self._connect()
+        try:
+            conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS jobs (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    payload TEXT NOT NULL,
+                    status TEXT NOT NULL DEFAULT 'queued',
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    worker TEXT,
+                    lease_expires REAL,
+                    result TEXT,
+                    error TEXT,
+                    created_at REAL NOT NULL,
+                    updated_at REAL NOT NULL
+                )
+                """
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, lease_expires)")
+        finally:
+            conn.close()
+
+    def _connect(self) -> sqlite3.Connection:
+        # Rollback journal rather than WAL: WAL's shared memory does not work across network filesystems.
+        conn = sqlite3.connect(self.path, timeout=self.timeout, isolation_level=None)
+        conn.execute("PRAGMA journal_mode=DELETE")
+        return conn
+
+    def _write(self, sql: str, params: tuple) -> int:
+        conn = self._connect()
+        try:
+            return conn.execute(sql, params).rowcount
+        finally:
+            conn.close()
+
+    def enqueue(self, payload: Dict[str, Any]) -> int:
+        now = time.time()
+        conn = self._connect()
+        try:
+            cursor = conn.execute(
+                "INSERT INTO jobs (payload, created_at, updated_at) VALUES (?, ?, ?)",
+                (json.dumps(payload), now, now),
+            )
+            return int(cursor.lastrowid)
+        finally:
+            conn.close()
+
+    def lease(self, worker_id: str, lease_seconds: float, max_attempts: int = 3) -> Optional[Job]:
+        now = time.time()
+        conn = self._connect()
+        try:
+            # BEGIN IMMEDIATE takes the write lock up front so two workers cannot lease the same row.
+            conn.execute("BEGIN IMMEDIATE")
+            conn.execute(
+                "UPDATE jobs SET status = 'failed', error = COALESCE(error, 'lease expired after final attempt'), "
+                "worker = NULL, lease_expires = NULL, updated_at = ? "
+                "WHERE status = 'leased' AND lease_expires < ? AND attempts >= ?",
+                (now, now, max_attempts),
+            )
+            row = conn.execute(
+                "SELECT id, payload, attempts FROM jobs "
+                "WHERE status = 'queued' OR (status = 'leased' AND lease_expires < ?) "
+                "ORDER BY id LIMIT 1",
+                (now,),
+            ).fetchone()
+            if row is None:
+                conn.execute("COMMIT")
+                return None
+            conn.execute(
+                "UPDATE jobs SET status = 'leased', worker = ?, lease_expires = ?, attempts = attempts + 1, updated_at = ? "
+                "WHERE id = ?",
+                (worker_id, now + lease_seconds, now, row[0]),
+            )
+            conn.execute("COMMIT")
+            return Job(id=row[0], payload=json.loads(row[1]), attempts=row[2] + 1)
+        except Exception:
+            if conn.in_transaction:
+                conn.execute("ROLLBACK")
+            raise
+        finally:
+            conn.close()
+
+    def heartbeat(self, job_id: int, worker_id: str, lease_seconds: float) -> bool:
+        now = time.time()
+        return self._write(
+            "UPDATE jobs SET lease_expires = ?, updated_at = ? WHERE id = ? AND worker = ? AND status = 'leased'",
+            (now + lease_seconds, now, job_id, worker_id),
+        ) == 1
+
+    def complete(self, job_id: int, worker_id: str, result: Dict[str, Any]) -> bool:
+        return self._write(
+            "UPDATE jobs SET status = 'done', result = ?, lease_expires = NULL, updated_at = ? "
+            "WHERE id = ? AND worker = ? AND status = 'leased'",
+            (json.dumps(result), time.time(), job_id, worker_id),
+        ) == 1
+
+    def fail(self, job_id: int, worker_id: str, error: str, max_attempts: int) -> bool:
+        return self._write(
+            "UPDATE jobs SET status = CASE WHEN attempts >= ? THEN 'failed' ELSE 'queued' END, "
+            "error = ?, worker = NULL, lease_expires = NULL, updated_at = ? "
+            "WHERE id = ? AND worker = ? AND status = 'leased'",
+            (max_attempts, error, time.time(), job_id, worker_id),
+        ) == 1
+
+    def counts(self) -> Dict[str, int]:
+        conn = self._connect()
+        try:
+            return dict(conn.execute("SELECT status, COUNT(*) FROM jobs GROUP BY status").fetchall())
+        finally:
+            conn.close()
+
+
+class MemoryJobQueue(JobQueue):
+    """In-process stand-in with the same lease semantics, for local runs and experiments."""
+
+    def __init__(self):
+        self.jobs: Dict[int, Dict[str, Any]] = {}
+        self.lock = threading.Lock()
+
+    def enqueue(self, payload: Dict[str, Any]) -> int:
+        with self.lock:
+            job_id = len(self.jobs) + 1
+            self.jobs[job_id] = {"payload": payload, "status": "queued", "attempts": 0, "worker": None, "lease_expires": None}
+            return job_id
+
+    def lease(self, worker_id: str, lease_seconds: float, max_attempts: int = 3) -> Optional[Job]:
+        now = time.time()
+        with self.lock:
+            for job_id, job in sorted(self.jobs.items()):
+                expired = job["status"] == "leased" and job["lease_expires"] < now
+                if expired and job["attempts"] >= max_attempts:
+                    job.update(status="failed", error=job.get("error") or "lease expired after final attempt", worker=None, lease_expires=None)
+                    continue
+                if job["status"] == "queued" or expired:
+                    job.update(status="leased", worker=worker_id, lease_expires=now + lease_seconds, attempts=job["attempts"] + 1)
+                    return Job(id=job_id, payload=job["payload"], attempts=job["attempts"])
+        return None
+
+    def _owned(self, job_id: int, worker_id: str) -> Optional[Dict[str, Any]]:
+        job = self.jobs.get(job_id)
+        if job and job["status"] == "leased" and job["worker"] == worker_id:
+            return job
+        return None
+
+    def heartbeat(self, job_id: int, worker_id: str, lease_seconds: float) -> bool:
+        with self.lock:
+            job = self._owned(job_id, worker_id)
+            if job:
+                job["lease_expires"] = time.time() + lease_seconds
+            return job is not None
+
+    def complete(self, job_id: int, worker_id: str, result: Dict[str, Any]) -> bool:
+        with self.lock:
+            job = self._owned(job_id, worker_id)
+            if job:
+                job.update(status="done", result=result, lease_expires=None)
+            return job is not None
+
+    def fail(self, job_id: int, worker_id: str, error: str, max_attempts: int) -> bool:
+        with self.lock:
+            job = self._owned(job_id, worker_id)
+            if job:
+                job.update(
+                    status="failed" if job["attempts"] >= max_attempts else "queued",
+                    error=error,
+                    worker=None,
+                    lease_expires=None,
+                )
+            return job is not None
+
+    def counts(self) -> Dict[str, int]:
+        with self.lock:
+            counts: Dict[str, int] = {}
+            for job in self.jobs.values():
+                counts[job["status"]] = counts.get(job["status"], 0) + 1
+            return counts
+
+
+def open_queue(spec: str) -> JobQueue:
+    """Open a queue from ``memory`` or a SQLite path (optionally prefixed with ``sqlite:///``).
+
+    ``memory`` only lives as long as this process, so it is meant for programmatic use.
+    """
+    if spec == "memory":
+        return MemoryJobQueue()
+    if spec.startswith("sqlite:///"):
+        spec = spec[len("sqlite:///"):]
+    return SQLiteJobQueue(os.path.expanduser(spec))
+
+
+def default_worker_id() -> str:
+    return f"{socket.gethostname()}-{os.getpid()}"
+
+
+def retry_locked(
+    action: Callable[[], Any], what: str, cancel: threading.Event, deadline: Optional[float] = None
+) -> Any:
+    """Run a queue call, retrying with backoff while SQLite reports the database as locked.
+
+    Gives up (re-raising the error) once ``cancel`` is set or ``deadline`` seconds have passed.
+    """
+    started = time.monotonic()
+    delay = 1.0
+    while True:
+        try:
+            return action()
+        except sqlite3.OperationalError as exc:
+            if cancel.is_set() or (deadline is not None and time.monotonic() - started + delay > deadline):
+                raise
+            print(f"! queue {what} failed ({exc}); retrying in {delay:.0f}s", file=sys.stderr, flush=True)
+            if cancel.wait(delay):
+                raise
+            delay = min(delay * 2, 30.0)
+
+
+def run_worker(
+    queue: JobQueue,
+    handler: Callable[[Dict[str, Any]], Dict[str, Any]],
+    worker_id: Optional[str] = None,
+    lease_seconds: float = 300.0,
+    poll_interval: float = 5.0,
+    max_attempts: int = 3,
+    exit_when_empty: bool = False,
+    stop: Optional[threading.Event] = None,
+) -> List[int]:
+    """Lease jobs and run ``handler`` on each payload, heartbeating the lease while it runs.
+
+    A job that raises is re-queued until it has been attempted ``max_attempts`` times. Queue calls
+    that hit a locked database are retried (see ``retry_locked``); completing or failing a job is
+    retried for at most one lease period, after which the lease has expired anyway. Returns the
+    ids of jobs this worker completed.
+    """
+    worker_id = worker_id or default_worker_id()
+    stop = stop or threading.Event()
+    completed: List[int] = []
+    while not stop.is_set():
+        try:
+            job = retry_locked(lambda: queue.lease(worker_id, lease_seconds, max_attempts), "lease", stop)
+        except sqlite3.OperationalError:
+            break
+        if job is None:
+            if exit_when_empty:
+                break
+            stop.wait(poll_interval)
+            continue
+
+        done = threading.Event()
+
+        def _heartbeat(job_id: int = job.id) -> None:
+            while not done.wait(lease_seconds / 3):
+                try:
+                    renewed = retry_locked(
+                        lambda: queue.heartbeat(job_id, worker_id, lease_seconds), "heartbeat", done, lease_seconds / 2
+                    )
+                except sqlite3.OperationalError:
+                    # Could not renew in time; if the lease lapses, completion will find it taken over.
+                    continue
+                if not renewed:
+                    # Lease lost (expired and taken over); the result will be discarded on completion.
+                    return
+
+        beat = threading.Thread(target=_heartbeat, name=f"lease-{job.id}", daemon=True)
+        beat.start()
+        try:
+            result = handler(job.payload)
+        except Exception as exc:
+            done.set()
+            beat.join()
+            error = f"{type(exc).__name__}: {exc}"
+            try:
+                retry_locked(lambda: queue.fail(job.id, worker_id, error, max_attempts), "fail", threading.Event(), lease_seconds)
+            except sqlite3.OperationalError:
+                # The lease expires and the job is retried elsewhere.
+                pass
+            continue
+        done.set()
+        beat.join()
+        try:
+            finished = retry_locked(lambda: queue.complete(job.id, worker_id, result), "complete", threading.Event(), lease_seconds)
+        except sqlite3.OperationalError:
+            continue
+        if finished:
+            completed.append(job.id)
+    return completed
+
+
+def run_workers(
+    queue: JobQueue,
+    handler: Callable[[Dict[str, Any]], Dict[str, Any]],
+    concurrency: int = 1,
+    worker_id: Optional[str] = None,
+    **kwargs: Any,
+) -> List[int]:
+    """Run ``concurrency`` workers as threads of this process, each leasing its own jobs.
+
+    Songs in flight at the same time let small local calls (scoring, triage) be coalesced.
+    Returns the ids of jobs completed by any of them.
+    """
+    worker_id = worker_id or default_worker_id()
+    if concurrency <= 1:
+        return run_worker(queue, handler, worker_id=worker_id, **kwargs)
+    completed: List[int] = []
+    lock = threading.Lock()
+
+    def _run(index: int) -> None:
+        done = run_worker(queue, handler, worker_id=f"{worker_id}-{index}", **kwargs)
+        with lock:
+            completed.extend(done)
+
+    threads = [threading.Thread(target=_run, args=(index,), name=f"worker-{index}") for index in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return sorted(completed)
@@ -0,0 +1,181 @@
+import os
+import sys
+import threading
+import time
+import tracemalloc
+from collections import Counter, defaultdict
+from contextlib import contextmanager, nullcontext
+from typing import Any, Callable, Dict, List, Optional
+
+
+def _frame_label(frame) -> str:
+    code = frame.f_code
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})".replace(";", ",")
+
+
+class StageProfiler:
+    """Sampling CPU profiler plus tracemalloc snapshots attributed to named pipeline stages.
+
+    A background thread samples, every ``interval`` seconds, the stacks of threads inside a stage
+    and of helper threads running work handed off from one (see ``follow_stage``). Other threads
+    (event loops, heartbeats, idle pool workers) are ignored, as are samples from threads whose CPU
+    clock did not advance since the last sample, so waiting on the network is not counted. Where
+    per-thread CPU clocks are unavailable (e.g. macOS) every sample is kept and the stacks are
+    wall-clock. Results are written as collapsed stacks (``<stage>.folded``, usable with
+    flamegraph.pl or speedscope), per-stage top-allocation reports (``<stage>.alloc.txt``) and a
+    ``summary.txt``. The summary's CPU column is process CPU time, so stages that overlap (merged
+    mode, concurrent workers) share the same seconds.
+    """
+
+    def __init__(self, output_dir: str, interval: float = 0.005, top: int = 15):
+        self.output_dir = output_dir
+        self.interval = interval
+        self.top = top
+        self.samples: Dict[str, Counter] = defaultdict(Counter)
+        self.alloc_reports: Dict[str, List[str]] = defaultdict(list)
+        self.totals: Dict[str, Dict[str, float]] = defaultdict(lambda: {"calls": 0, "wall": 0.0, "cpu": 0.0, "mem_delta": 0})
+        self.stacks: Dict[int, List[str]] = {}
+        self.cpu_seen: Dict[int, float] = {}
+        self.lock = threading.Lock()
+        self._stop = threading.Event()
+        self._sampler: Optional[threading.Thread] = None
+
+    def start(self) -> None:
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(25)
+        self._sampler = threading.Thread(target=self._sample_loop, name="stage-profiler", daemon=True)
+        self._sampler.start()
+
+    def stop(self) -> str:
+        self._stop.set()
+        if self._sampler is not None:
+            self._sampler.join()
+        tracemalloc.stop()
+        return self.write_reports()
+
+    def _on_cpu(self, thread_id: int) -> bool:
+        """Whether ``thread_id`` used CPU since its last sample (always True without per-thread clocks)."""
+        try:
+            cpu = time.clock_gettime(time.pthread_getcpuclockid(thread_id))
+        except (AttributeError, OSError):
+            return True
+        previous = self.cpu_seen.get(thread_id)
+        self.cpu_seen[thread_id] = cpu
+        # A thread's first sample has nothing to compare with, so it is skipped rather than guessed.
+        return previous is not None and cpu > previous
+
+    def _sample_loop(self) -> None:
+        while not self._stop.wait(self.interval):
+            frames = sys._current_frames()
+            with self.lock:
+                for thread_id, frame in frames.items():
+                    stage_stack = self.stacks.get(thread_id)
+                    if not stage_stack or not self._on_cpu(thread_id):
+                        continue
+                    stage = "/".join(stage_stack)
+                    labels = []
+                    while frame is not None:
+                        labels.append(_frame_label(frame))
+                        frame = frame.f_back
+                    self.samples[stage][";".join(reversed(labels))] += 1
+
+    @contextmanager
+    def stage(self, name: str):
+        thread_id = threading.get_ident()
+        with self.lock:
+            stack = self.stacks.setdefault(thread_id, [])
+            stack.append(name)
+            path = "/".join(stack)
+        before = tracemalloc.take_snapshot()
+        started_wall = time.perf_counter()
+        started_cpu = time.process_time()
+        try:
+            yield
+        finally:
+            wall = time.perf_counter() - started_wall
+            # Process-wide CPU, so work done by a stage's helper threads (parallel reviewers) counts.
+            cpu = time.process_time() - started_cpu
+            after = tracemalloc.take_snapshot()
+            diff = after.compare_to(before, "lineno")
+            with self.lock:
+                stack.pop()
+                if not stack:
+                    self.stacks.pop(thread_id, None)
+                totals = self.totals[path]
+                totals["calls"] += 1
+                totals["wall"] += wall
+                totals["cpu"] += cpu
+                totals["mem_delta"] += sum(stat.size_diff for stat in diff)
+                lines = [f"--- call {int(totals['calls'])}: wall {wall:.3f}s, cpu {cpu:.3f}s"]
+                lines.extend(str(stat) for stat in diff[: self.top])
+                self.alloc_reports[path].append("\n".join(lines))
+
+    @contextmanager
+    def attached(self, path: str):
+        """Sample the current (helper) thread under stage ``path`` without adding a stage call."""
+        thread_id = threading.get_ident()
+        with self.lock:
+            stack = self.stacks.setdefault(thread_id, [])
+            stack.append(path)
+        try:
+            yield
+        finally:
+            with self.lock:
+                stack.pop()
+                if not stack:
+                    self.stacks.pop(thread_id, None)
+
+    def current_path(self) -> Optional[str]:
+        with self.lock:
+            stack = self.stacks.get(threading.get_ident())
+            return "/".join(stack) if stack else None
+
+    def write_reports(self) -> str:
+        os.makedirs(self.output_dir, exist_ok=True)
+        with self.lock:
+            for path, counter in self.samples.items():
+                name = path.replace("/", ".")
+                with open(os.path.join(self.output_dir, f"{name}.folded"), "w") as file:
+                    for stack, count in counter.most_common():
+                        file.write(f"{path};{stack} {count}\n")
+            for path, reports in self.alloc_reports.items():
+                name = path.replace("/", ".")
+                with open(os.path.join(self.output_dir, f"{name}.alloc.txt"), "w") as file:
+                    file.write("\n\n".join(reports) + "\n")
+            summary_path = os.path.join(self.output_dir, "summary.txt")
+            with open(summary_path, "w") as file:
+                file.write(f"{'stage':<32} {'calls':>5} {'wall s':>9} {'cpu s':>9} {'samples':>8} {'mem KiB':>10}\n")
+                for path, totals in sorted(self.totals.items(), key=lambda item: -item[1]["wall"]):
+                    samples = sum(self.samples.get(path, Counter()).values())
+                    file.write(
+                        f"{path:<32} {int(totals['calls']):>5} {totals['wall']:>9.3f} {totals['cpu']:>9.3f} "
+                        f"{samples:>8} {totals['mem_delta'] / 1024:>10.1f}\n"
+                    )
+        return summary_path
+
+
+_active: Optional[StageProfiler] = None
+
+
+def use_profiler(profiler: Optional[StageProfiler]) -> None:
+    global _active
+    _active = profiler
+
+
+def profile_stage(name: str):
+    """Context manager attributing CPU samples and allocations to ``name`` when profiling is on."""
+    return _active.stage(name) if _active is not None else nullcontext()
+
+
+def follow_stage(fn: Callable[..., Any]) -> Callable[..., Any]:
+    """Wrap work handed to a helper thread so it is sampled under the caller's current stage."""
+    profiler = _active
+    path = profiler.current_path() if profiler is not None else None
+    if path is None:
+        return fn
+
+    def _run(*args: Any, **kwargs: Any) -> Any:
+        with profiler.attached(path):
+            return fn(*args, **kwargs)
+
+    return _run
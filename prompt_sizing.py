@@ -0,0 +1,139 @@
+import functools
+import os
+from typing import Callable, Dict, List, Mapping, Optional, Tuple
+
+# Resource sections dropped first when a prompt does not fit; remaining sections (tag files and
+# then core styles) follow, largest first, so the reduction is the same on every run.
+RESOURCE_DROP_ORDER = ("example_styles", "artist_styles")
+PROTECTED_LAST = ("core_styles",)
+
+
+class PromptTooLarge(ValueError):
+    """Raised when a prompt cannot be reduced to fit the model's context window."""
+
+
+@functools.lru_cache(maxsize=None)
+def _encoder() -> Callable[[str], int]:
+    """Pick the best available tokenizer: PROMPT_TOKENIZER (Hugging Face name), tiktoken, else ~4 chars/token."""
+    name = os.getenv("PROMPT_TOKENIZER")
+    if name:
+        try:
+            from transformers import AutoTokenizer
+
+            tokenizer = AutoTokenizer.from_pretrained(name)
+            return lambda text: len(tokenizer.encode(text, add_special_tokens=False))
+        except Exception:
+            pass
+    try:
+        import tiktoken
+
+        encoding = tiktoken.get_encoding(os.getenv("PROMPT_TIKTOKEN_ENCODING", "cl100k_base"))
+        return lambda text: len(encoding.encode(text, disallowed_special=()))
+    except Exception:
+        return lambda text: (len(text) + 3) // 4
+
+
+def count_tokens(text: Optional[str]) -> int:
+    return _encoder()(text) if text else 0
+
+
+def drop_order(styles: Mapping[str, str], tags: Mapping[str, str]) -> List[Tuple[str, str]]:
+    """Deterministic order in which (kind, key) resource sections are dropped to save tokens."""
+    sections = [("styles", key) for key in RESOURCE_DROP_ORDER if key in styles]
+    rest = [("tags", key) for key in tags]
+    rest += [("styles", key) for key in styles if key not in RESOURCE_DROP_ORDER and key not in PROTECTED_LAST]
+    resources = {"styles": styles, "tags": tags}
+    sections += sorted(rest, key=lambda section: (-len(resources[section[0]][section[1]]), section))
+    return sections + [("styles", key) for key in PROTECTED_LAST if key in styles]
+
+
+def fit_resources(
+    render: Callable[[Mapping[str, str], Mapping[str, str]], Tuple[str, str]],
+    styles: Mapping[str, str],
+    tags: Mapping[str, str],
+    budget: int,
+) -> Tuple[str, str, List[str]]:
+    """Render a prompt, dropping resource sections in ``drop_order`` until it fits ``budget`` tokens.
+
+    Returns ``(system, user, dropped)`` where ``dropped`` names the removed sections.
+    """
+    kept_styles, kept_tags = dict(styles), dict(tags)
+    dropped: List[str] = []
+    pending = drop_order(styles, tags)
+    system, user = render(kept_styles, kept_tags)
+    total = count_tokens(system) + count_tokens(user)
+    while total > budget:
+        if not pending:
+            raise PromptTooLarge(f"Prompt needs {total} tokens even without resources; budget is {budget}")
+        # Drop as many sections as the estimated saving requires, then re-measure the real prompt.
+        excess = total - budget
+        while pending and excess > 0:
+            kind, key = pending.pop(0)
+            section = (kept_styles if kind == "styles" else kept_tags).pop(key)
+            excess -= count_tokens(section)
+            dropped.append(f"{kind}:{key}")
+        system, user = render(kept_styles, kept_tags)
+        total = count_tokens(system) + count_tokens(user)
+    return system, user, dropped
+
+
+def trim_to_tokens(text: str, budget: int) -> str:
+    """Keep lines from the start of ``text`` (feedback is ranked most important first) within ``budget``.
+
+    The first line that does not fit is cut at a word boundary, so a single long paragraph is
+    shortened rather than dropped.
+    """
+    if count_tokens(text) <= budget:
+        return text
+    kept: List[str] = []
+    used = 0
+    for line in text.splitlines():
+        cost = count_tokens(line + "\n")
+        if used + cost > budget:
+            kept.append(_cut_words(line, budget - used - 1))
+            break
+        kept.append(line)
+        used += cost
+    return "\n".join(kept).rstrip()
+
+
+def _cut_words(line: str, budget: int) -> str:
+    """Longest word-boundary prefix of ``line`` within ``budget`` tokens (binary search on word count)."""
+    words = line.split(" ")
+    low, high = 0, len(words)
+    while low < high:
+        middle = (low + high + 1) // 2
+        if count_tokens(" ".join(words[:middle])) <= budget:
+            low = middle
+        else:
+            high = middle - 1
+    return " ".join(words[:low]).rstrip()
+
+
+def _safety_tokens() -> int:
+    return int(os.getenv("PROMPT_SAFETY_TOKENS", "256"))
+
+
+def context_budget(window: Optional[int], reserved_output: int) -> Optional[int]:
+    """Tokens available for the prompt: the window minus the output reservation and a safety margin.
+
+    At most PROMPT_OUTPUT_SHARE of the window is reserved, so an output cap as large as the window
+    (LLM_MAX_TOKENS=8192 on an 8k model) still leaves room for the prompt.
+    """
+    if not window:
+        return None
+    reserved = min(reserved_output, int(window * float(os.getenv("PROMPT_OUTPUT_SHARE", "0.5"))))
+    return max(0, window - reserved - _safety_tokens())
+
+
+def output_allowance(window: Optional[int], prompt_tokens: int) -> Optional[int]:
+    """Output tokens left once the prompt and safety margin are in the window, or None when it is unknown."""
+    if not window:
+        return None
+    return window - prompt_tokens - _safety_tokens()
+
+
+def size_report(stage: str, parts: Dict[str, int], budget: Optional[int]) -> str:
+    detail = ", ".join(f"{name} {tokens}" for name, tokens in parts.items())
+    limit = f" / {budget} available" if budget is not None else ""
+    return f"[{stage}] prompt {sum(parts.values())} tokens ({detail}){limit}"
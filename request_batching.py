@@ -0,0 +1,62 @@
+import contextvars
+import threading
+from concurrent.futures import Future
+from typing import Any, Callable, List, Tuple
+
+
+class MicroBatcher:
+    """Collect requests submitted from many threads for a short window and run them as one batch.
+
+    The first submission opens a window of ``window`` seconds; everything submitted before it
+    closes (or until ``max_items`` is reached) is handed to ``handler`` as a single list, and each
+    caller blocks until its own result is available. The batch may run on a timer thread, so the
+    handler also gets a copy of each caller's context (usage meters, cassette) in item order.
+    """
+
+    def __init__(self, handler: Callable[[List[Any], List[contextvars.Context]], List[Any]], window: float, max_items: int):
+        self.handler = handler
+        self.window = window
+        self.max_items = max(1, max_items)
+        self._pending: List[Tuple[Any, Future, contextvars.Context]] = []
+        self._timer = None
+        self._lock = threading.Lock()
+
+    def submit(self, item: Any) -> Any:
+        future: Future = Future()
+        batch = None
+        with self._lock:
+            self._pending.append((item, future, contextvars.copy_context()))
+            if len(self._pending) >= self.max_items:
+                batch = self._take()
+            elif self._timer is None:
+                self._timer = threading.Timer(self.window, self._flush)
+                self._timer.daemon = True
+                self._timer.start()
+        if batch:
+            self._run(batch)
+        return future.result()
+
+    def _take(self) -> List[Tuple[Any, Future, contextvars.Context]]:
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        batch, self._pending = self._pending, []
+        return batch
+
+    def _flush(self) -> None:
+        with self._lock:
+            batch = self._take()
+        if batch:
+            self._run(batch)
+
+    def _run(self, batch: List[Tuple[Any, Future, contextvars.Context]]) -> None:
+        try:
+            results = self.handler([item for item, _, _ in batch], [context for _, _, context in batch])
+            if len(results) != len(batch):
+                raise RuntimeError(f"Batch handler returned {len(results)} results for {len(batch)} items")
+        except Exception as exc:
+            for _, future, _ in batch:
+                future.set_exception(exc)
+            return
+        for (_, future, _), result in zip(batch, results):
+            future.set_result(result)
@@ -6,9 +6,13 @@ It supports both local and remote LLM usage, with options for personas, album ar
 """
 
 import argparse
+import functools
+import glob
 import os
 import sys
-from typing import Optional
+import time
+import uuid
+from typing import Any, Dict, List, Optional
 
 from dotenv import load_dotenv
 from langgraph.graph import END, StateGraph
@@ -18,45 +22,122 @@ from ai_functions import (
     build_prompts,
     critique_song,
     draft_song,
+    env_flag,
+    gather_merged_feedback,
     generate_metadata_summary,
     preflight_song,
     revise_lyrics,
+    revision_feedback_budget,
     run_parallel_reviews,
     score_lyrics,
     triage_preflight,
 )
+from budget import Budget, activate_meter, budget_exhausted, deactivate_meter, finish_run, run_meter, start_run
+from cassette import Cassette, use_cassette
 from helpers import (
-    SongResources,
     SongState,
+    acquire_resources,
     enhance_user_input,
     extract_song_details_for_art,
+    expand_song_paths,
     extract_title,
     generate_album_art,
+    get_resources,
     load_prompt_from_file,
-    load_resources,
+    load_song_record,
+    load_song_state,
     parse_persona,
+    regenerate_covers,
     save_song,
+    state_payload_size,
 )
+from job_queue import open_queue, run_workers
+from profiling import StageProfiler, profile_stage, use_profiler
 
 load_dotenv()
 
 
-def generate_song(user_input: str, use_local: bool = False, song_name: Optional[str] = None, persona: Optional[str] = None):
-    (
-        drafter_prompt,
-        review_prompt,
-        critic_prompt,
-        preflight_prompt,
-        revision_prompt,
-        scoring_prompt,
-        metadata_prompt,
-        preflight_triage_prompt,
-    ) = build_prompts()
+def metered(node_name: str, node):
+    """Run a graph node with its song's usage meter active and fold usage and budget status into the update."""
+    @functools.wraps(node)
+    def wrapper(state: SongState):
+        meter = run_meter(state["run_id"])
+        token = activate_meter(meter)
+        started = time.perf_counter()
+        try:
+            with profile_stage(node_name):
+                update = dict(node(state))
+        finally:
+            deactivate_meter(token)
+        timings = dict(state.get("timings", {}))
+        timings[node_name] = round(timings.get(node_name, 0.0) + time.perf_counter() - started, 3)
+        update["timings"] = timings
+        if meter is not None:
+            update["usage"] = meter.snapshot()
+        reason = budget_exhausted(state)
+        if reason and not state.get("budget_exhausted"):
+            update["budget_exhausted"] = reason
+            update["budget_decisions"] = update.get("budget_decisions", state.get("budget_decisions", [])) + [
+                f"Budget nearly exhausted after {node_name} ({reason}); skipping remaining optional stages"
+            ]
+            tqdm.write(f"! Budget nearly exhausted after {node_name}: {reason}")
+        return update
+
+    return wrapper
+
+
+GRAPH_MODES = ("sequential", "merged")
+# Stages that can be re-run on a saved song, in pipeline order.
+RERUN_STAGES = ("critic", "preflight", "metadata", "album_art", "save")
+
+
+def generate_song(
+    user_input: str,
+    use_local: bool = False,
+    song_name: Optional[str] = None,
+    persona: Optional[str] = None,
+    budget: Optional[Budget] = None,
+    graph_mode: Optional[str] = None,
+    seed_state: Optional[Dict[str, Any]] = None,
+    stages: Optional[List[str]] = None,
+):
+    """Run the agentic graph for one song.
+
+    With ``seed_state`` (see ``helpers.load_song_state``) and ``stages``, only the selected
+    ``RERUN_STAGES`` run, in pipeline order, on an already written song.
+
+    ``graph_mode`` (default GRAPH_MODE, else "sequential") selects the flow: "merged" gathers the
+    critic's feedback (and preflight analysis with MERGE_PREFLIGHT) concurrently with each review
+    round's reviewers and applies everything in that round's single revision, removing the serial
+    critic and preflight round-trips after the loop.
+    """
+    unknown = sorted(set(stages or []) - set(RERUN_STAGES))
+    if unknown:
+        raise ValueError(f"Unknown stage(s): {', '.join(unknown)} (expected any of {', '.join(RERUN_STAGES)})")
+    graph_mode = graph_mode or os.getenv("GRAPH_MODE", "sequential")
+    if graph_mode not in GRAPH_MODES:
+        raise ValueError(f"Unknown graph mode: {graph_mode} (expected one of {', '.join(GRAPH_MODES)})")
+    merge_preflight = graph_mode == "merged" and env_flag("MERGE_PREFLIGHT")
+    with profile_stage("build_prompts"):
+        (
+            drafter_prompt,
+            review_prompt,
+            critic_prompt,
+            preflight_prompt,
+            revision_prompt,
+            scoring_prompt,
+            metadata_prompt,
+            preflight_triage_prompt,
+        ) = build_prompts()
 
     persona_name = parse_persona(user_input, persona)
-    resources = load_resources(persona_name)
+    with profile_stage("load_resources"):
+        resources_key = acquire_resources(persona_name)
     max_rounds = int(os.getenv("REVIEW_MAX_ROUNDS", "3"))
     score_threshold = float(os.getenv("REVIEW_SCORE_THRESHOLD", "8.0"))
+    run_id = uuid.uuid4().hex[:12]
+    budget = budget or Budget.from_env("SONG")
+    start_run(run_id)
 
     initial_state: SongState = {
         "user_input": user_input,
@@ -64,10 +145,12 @@ def generate_song(user_input: str, use_local: bool = False, song_name: Optional[
         "persona": persona,
         "persona_name": persona_name,
         "use_local": use_local,
-        "resources": resources,
+        "run_id": run_id,
+        "resources_key": resources_key,
         "lyrics": "",
         "feedback": "",
         "score": 0.0,
+        "score_history": [],
         "round": 0,
         "max_rounds": max_rounds,
         "score_threshold": score_threshold,
@@ -76,32 +159,71 @@ def generate_song(user_input: str, use_local: bool = False, song_name: Optional[
         "metadata": {},
         "filename": None,
         "album_art": None,
+        "budget": budget.as_dict(),
+        "usage": {},
+        "budget_exhausted": None,
+        "budget_decisions": [],
+        "timings": {},
     }
+    if seed_state:
+        # An explicit persona wins over the one the saved song was written with.
+        initial_state.update({key: value for key, value in seed_state.items() if not (persona and key == "persona_name")})
 
     def draft_node(state: SongState):
         """Generate initial song draft using AI."""
         enhanced_input = enhance_user_input(state["user_input"], state.get("song_name"))
+        resources = get_resources(state["resources_key"])
         lyrics = draft_song(
             prompt_template=drafter_prompt,
             enhanced_input=enhanced_input,
-            styles=state["resources"].styles,
-            tags=state["resources"].tags,
-            persona_styles=state["resources"].persona_styles,
-            default_params=state["resources"].default_params,
+            styles=resources.styles,
+            tags=resources.tags,
+            persona_styles=resources.persona_styles,
+            default_params=resources.default_params,
             use_local=state["use_local"],
         )
         tqdm.write("✓ Draft generated.")
         return {"lyrics": lyrics}
 
     def review_node(state: SongState):
-        feedback = run_parallel_reviews(review_prompt, state["lyrics"], state["use_local"])
+        if state.get("budget_exhausted"):
+            return {}
+        update: Dict[str, Any] = {}
+        feedback_budget = revision_feedback_budget(revision_prompt, state["lyrics"], state["use_local"])
+        if graph_mode == "merged":
+            resources = get_resources(state["resources_key"])
+            feedback, triaged = gather_merged_feedback(
+                review_prompt,
+                critic_prompt,
+                state["lyrics"],
+                state["use_local"],
+                preflight_prompt=preflight_prompt if merge_preflight else None,
+                triage_prompt=preflight_triage_prompt if merge_preflight else None,
+                styles=resources.styles,
+                tags=resources.tags,
+                token_budget=feedback_budget,
+            )
+            if triaged is not None:
+                # Issues are folded into this round's revision rather than re-checked afterwards.
+                update = {"preflight_passed": bool(triaged.get("pass", False)), "preflight_issues": triaged.get("issues", [])}
+        else:
+            feedback = run_parallel_reviews(review_prompt, state["lyrics"], state["use_local"], token_budget=feedback_budget)
         revised_lyrics = revise_lyrics(revision_prompt, state["lyrics"], feedback, state["use_local"])
         score = score_lyrics(scoring_prompt, revised_lyrics, state["use_local"])
         tqdm.write(f"✓ Review round {state['round'] + 1}: score {score:.2f}")
-        return {"lyrics": revised_lyrics, "feedback": feedback, "score": score, "round": state["round"] + 1}
+        update.update(
+            lyrics=revised_lyrics,
+            feedback=feedback,
+            score=score,
+            score_history=state.get("score_history", []) + [score],
+            round=state["round"] + 1,
+        )
+        return update
 
     def review_router(state: SongState):
-        """Decide whether to continue reviewing or proceed to critic based on score and rounds."""
+        """Decide whether to continue reviewing or proceed to critic based on score, rounds and budget."""
+        if state.get("budget_exhausted"):
+            return "skip_to_metadata"
         if state["score"] < state["score_threshold"] and state["round"] < state["max_rounds"]:
             return "keep_reviewing"
         return "go_critic"
@@ -112,7 +234,11 @@ def generate_song(user_input: str, use_local: bool = False, song_name: Optional[
         return {"lyrics": revised}
 
     def preflight_node(state: SongState):
-        raw = preflight_song(preflight_prompt, state["lyrics"], state["resources"].styles, state["resources"].tags, state["use_local"])
+        if state.get("budget_exhausted"):
+            tqdm.write("! Preflight skipped (budget).")
+            return {"budget_decisions": state.get("budget_decisions", []) + ["Skipped preflight checks"]}
+        resources = get_resources(state["resources_key"])
+        raw = preflight_song(preflight_prompt, state["lyrics"], resources.styles, resources.tags, state["use_local"])
         triaged = triage_preflight(preflight_triage_prompt, raw, state["use_local"])
         passed = bool(triaged.get("pass", False))
         issues = triaged.get("issues", [])
@@ -123,6 +249,8 @@ def generate_song(user_input: str, use_local: bool = False, song_name: Optional[
         return {"preflight_passed": passed, "preflight_issues": issues}
 
     def preflight_router(state: SongState):
+        if state.get("budget_exhausted"):
+            return "ready_for_metadata"
         if not state["preflight_passed"] and state["round"] < state["max_rounds"]:
             return "needs_fix"
         return "ready_for_metadata"
@@ -136,12 +264,13 @@ def generate_song(user_input: str, use_local: bool = False, song_name: Optional[
         return {"lyrics": revised, "feedback": feedback, "round": state["round"] + 1}
 
     def metadata_node(state: SongState):
+        resources = get_resources(state["resources_key"])
         metadata = generate_metadata_summary(
             metadata_prompt,
             state["lyrics"],
             state["user_input"],
-            state["resources"].default_params,
-            state["resources"].persona_styles,
+            resources.default_params,
+            resources.persona_styles,
             state["use_local"],
         )
         tqdm.write("✓ Metadata summary generated.")
@@ -152,30 +281,87 @@ def generate_song(user_input: str, use_local: bool = False, song_name: Optional[
         if state["use_local"]:
             tqdm.write("✓ Album artwork skipped (local mode).")
             return {"album_art": None}
+        if state.get("budget_exhausted"):
+            tqdm.write("! Album artwork skipped (budget).")
+            return {"album_art": None, "budget_decisions": state.get("budget_decisions", []) + ["Skipped album artwork"]}
         title = extract_title(state["lyrics"], state.get("song_name"))
-        artwork_path = generate_album_art(title, state["user_input"])
+        artwork_path = generate_album_art(title, state["user_input"], run_id=state["run_id"])
         tqdm.write(f"✓ Album artwork generated: {artwork_path}")
         return {"album_art": artwork_path}
 
     def save_node(state: SongState):
         title = extract_title(state["lyrics"], state.get("song_name"))
-        filename = save_song(title, state["user_input"], state["lyrics"], state["resources"].default_params, state["metadata"])
+        record = {
+            "song_name": state.get("song_name"),
+            "persona_name": state.get("persona_name"),
+            "use_local": state["use_local"],
+            "resources_key": state["resources_key"],
+            "score": state["score"],
+            "score_history": state.get("score_history", []),
+            "rounds": state["round"],
+            "preflight_passed": state["preflight_passed"],
+            "preflight_issues": state.get("preflight_issues", []),
+            "usage": state.get("usage", {}),
+            "budget": state.get("budget", {}),
+            "budget_exhausted": state.get("budget_exhausted"),
+            "timings": state.get("timings", {}),
+        }
+        with profile_stage("save_song"):
+            filename = save_song(
+                title,
+                state["user_input"],
+                state["lyrics"],
+                get_resources(state["resources_key"]).default_params,
+                state["metadata"],
+                notes=state.get("budget_decisions"),
+                run_id=state["run_id"],
+                album_art=state.get("album_art"),
+                record=record,
+            )
         tqdm.write(f"✓ Song saved to {filename}")
         return {"filename": filename}
 
+    nodes = {
+        "draft": draft_node,
+        "review": review_node,
+        "critic": critic_node,
+        "preflight": preflight_node,
+        "targeted_revise": targeted_revise_node,
+        "metadata": metadata_node,
+        "album_art": album_art_node,
+        "save": save_node,
+    }
     graph = StateGraph(SongState)
-    graph.add_node("draft", draft_node)
-    graph.add_node("review", review_node)
-    graph.add_node("critic", critic_node)
-    graph.add_node("preflight", preflight_node)
-    graph.add_node("targeted_revise", targeted_revise_node)
-    graph.add_node("metadata", metadata_node)
-    graph.add_node("album_art", album_art_node)
-    graph.add_node("save", save_node)
+    if stages:
+        _add_stage_chain(graph, nodes, stages, preflight_router)
+    else:
+        _add_full_graph(graph, nodes, graph_mode, merge_preflight, review_router, preflight_router)
+
+    # Compile and execute the graph
+    app = graph.compile()
+    try:
+        with tqdm(total=None, desc="Creating your song (agentic)", unit="step") as _:
+            final_state = app.invoke(initial_state)
+    finally:
+        finish_run(run_id)
+    if env_flag("LOG_STATE_SIZE"):
+        tqdm.write(f"State payload: {state_payload_size(final_state)} bytes")
+    return final_state
+
+
+def _add_full_graph(graph: StateGraph, nodes: Dict[str, Any], graph_mode: str, merge_preflight: bool, review_router, preflight_router) -> None:
+    for name, node in nodes.items():
+        graph.add_node(name, metered(name, node))
 
     graph.set_entry_point("draft")
     graph.add_edge("draft", "review")
-    graph.add_conditional_edges("review", review_router, {"keep_reviewing": "review", "go_critic": "critic"})
+    # In merged mode the critic (and optionally preflight) already ran inside the review rounds.
+    after_reviews = "critic"
+    if graph_mode == "merged":
+        after_reviews = "metadata" if merge_preflight else "preflight"
+    graph.add_conditional_edges(
+        "review", review_router, {"keep_reviewing": "review", "go_critic": after_reviews, "skip_to_metadata": "metadata"}
+    )
     graph.add_edge("critic", "preflight")
     graph.add_conditional_edges("preflight", preflight_router, {"needs_fix": "targeted_revise", "ready_for_metadata": "metadata"})
     graph.add_edge("targeted_revise", "review")
@@ -183,10 +369,32 @@ def generate_song(user_input: str, use_local: bool = False, song_name: Optional[
     graph.add_edge("album_art", "save")
     graph.add_edge("save", END)
 
-    # Compile and execute the graph
-    app = graph.compile()
-    with tqdm(total=None, desc="Creating your song (agentic)", unit="step") as _:
-        app.invoke(initial_state)
+
+def _add_stage_chain(graph: StateGraph, nodes: Dict[str, Any], stages: List[str], preflight_router) -> None:
+    """Wire the selected post-review stages in pipeline order; preflight keeps its targeted fix step."""
+    ordered = [name for name in RERUN_STAGES if name in stages]
+    for name in ordered + (["targeted_revise"] if "preflight" in ordered else []):
+        graph.add_node(name, metered(name, nodes[name]))
+
+    graph.set_entry_point(ordered[0])
+    for current, following in zip(ordered, ordered[1:] + [END]):
+        if current == "preflight":
+            graph.add_conditional_edges("preflight", preflight_router, {"needs_fix": "targeted_revise", "ready_for_metadata": following})
+            graph.add_edge("targeted_revise", following)
+        else:
+            graph.add_edge(current, following)
+
+
+def run_song_job(payload: Dict[str, Any]) -> Dict[str, Any]:
+    """Queue handler: generate one song from a job payload and report where it was written."""
+    final_state = generate_song(
+        payload["prompt"],
+        bool(payload.get("local")),
+        payload.get("name"),
+        payload.get("persona"),
+        graph_mode=payload.get("graph_mode"),
+    )
+    return {"filename": final_state.get("filename"), "album_art": final_state.get("album_art")}
 
 
 if __name__ == "__main__":
@@ -206,35 +414,220 @@ if __name__ == "__main__":
         default=None,
         help='Specify the persona by name (e.g., "antidote") or by path to a persona .md file',
     )
+    parser.add_argument(
+        "--from-song",
+        type=str,
+        default=None,
+        help="Re-run selected stages (see --stages) on an existing song markdown file instead of generating a new song",
+    )
+    parser.add_argument(
+        "--stages",
+        type=str,
+        default="metadata,save",
+        help=f"Comma-separated stages for --from-song, from: {', '.join(RERUN_STAGES)} (default: metadata,save)",
+    )
+    parser.add_argument(
+        "--graph-mode",
+        choices=GRAPH_MODES,
+        default=None,
+        help="sequential (default): critic and preflight after the review loop; merged: critic runs alongside the reviewers",
+    )
     parser.add_argument(
         "--regen-cover",
         type=str,
         default=None,
-        help="Path to an existing song markdown file to regenerate album art and exit",
+        help="Song markdown file, directory of songs, or glob pattern to regenerate album art for, then exit",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=int(os.getenv("COVER_WORKERS", "4")),
+        help="Concurrent cover generations when --regen-cover targets several songs",
+    )
+    parser.add_argument(
+        "--force",
+        action="store_true",
+        help="Regenerate covers that are already up to date and bypass the image cache",
+    )
+    parser.add_argument(
+        "--record",
+        type=str,
+        default=None,
+        help="Record every LLM and image request/response to this cassette file",
     )
+    parser.add_argument(
+        "--replay",
+        type=str,
+        default=None,
+        help="Serve LLM and image responses from this cassette file instead of the network",
+    )
+    parser.add_argument(
+        "--replay-latency",
+        type=str,
+        default=None,
+        help='Simulated latency per replayed call: seconds, or "recorded" to reuse the recorded latencies',
+    )
+    parser.add_argument(
+        "--profile",
+        type=str,
+        nargs="?",
+        const="profiles",
+        default=None,
+        help="Profile CPU (sampling) and memory (tracemalloc) per graph node and write reports to this directory",
+    )
+    parser.add_argument(
+        "--queue",
+        type=str,
+        default=os.getenv("SONG_QUEUE", "queue/songs.db"),
+        help="Job queue: path to a SQLite file on shared storage",
+    )
+    parser.add_argument(
+        "--enqueue",
+        action="store_true",
+        help="Add the prompt (or every file matched by --prompt-file, globs allowed) to the job queue and exit",
+    )
+    parser.add_argument("--worker", action="store_true", help="Run as a worker that pulls song jobs from the queue")
+    parser.add_argument("--worker-id", type=str, default=None, help="Worker identity recorded on leases (default host-pid)")
+    parser.add_argument(
+        "--concurrency",
+        type=int,
+        default=int(os.getenv("WORKER_CONCURRENCY", "1")),
+        help="Songs a worker generates at once (threads in one process)",
+    )
+    parser.add_argument("--exit-when-empty", action="store_true", help="Stop the worker once the queue has no leasable jobs")
 
     args = parser.parse_args()
 
-    if args.regen_cover:
+    if args.record and args.replay:
+        parser.error("--record and --replay cannot be used together")
+    cassette = None
+    if args.record or args.replay:
         try:
-            title, user_prompt = extract_song_details_for_art(args.regen_cover)
-        except (FileNotFoundError, ValueError) as regen_err:
-            parser.error(str(regen_err))
-            sys.exit(2)
-        artwork_path = generate_album_art(title, user_prompt or "Use the song metadata to inspire the cover art.")
-        print(f"Album art regenerated: {artwork_path}")
-        sys.exit(0)
-
-    # Load prompt from file or argument
+            cassette = Cassette(args.record or args.replay, "record" if args.record else "replay", args.replay_latency)
+        except FileNotFoundError as cassette_err:
+            parser.error(str(cassette_err))
+        use_cassette(cassette)
+
+    # Started before every mode so --regen-cover and --from-song runs are profiled too.
+    profiler = None
+    if args.profile:
+        profiler = StageProfiler(args.profile)
+        use_profiler(profiler)
+        profiler.start()
+
     try:
-        prompt_text = load_prompt_from_file(args.prompt_file) if args.prompt_file else args.prompt
-    except FileNotFoundError as prompt_err:
-        parser.error(str(prompt_err))
-        sys.exit(2)
+        if args.regen_cover:
+            song_paths = expand_song_paths(args.regen_cover)
+            if len(song_paths) == 1 and song_paths[0] == os.path.expanduser(args.regen_cover):
+                # A single explicit file always gets fresh artwork, as before bulk mode existed.
+                try:
+                    title, user_prompt = extract_song_details_for_art(args.regen_cover)
+                except (FileNotFoundError, ValueError) as regen_err:
+                    parser.error(str(regen_err))
+                    sys.exit(2)
+                record = load_song_record(args.regen_cover)
+                artwork_path = generate_album_art(
+                    title,
+                    user_prompt or "Use the song metadata to inspire the cover art.",
+                    use_cache=False,
+                    run_id=record.get("run_id") if record else None,
+                )
+                if cassette:
+                    cassette.save()
+                print(f"Album art regenerated: {artwork_path}")
+                sys.exit(0)
+            if not song_paths:
+                parser.error(f"No song files matched: {args.regen_cover}")
+                sys.exit(2)
+            results = regenerate_covers(song_paths, workers=args.workers, force=args.force)
+            if cassette:
+                cassette.save()
+            for song_path, artwork_path, status in results:
+                print(f"{status}: {song_path} -> {artwork_path}")
+            sys.exit(1 if any(status == "failed" or status.startswith("error") for _, _, status in results) else 0)
+
+        if args.from_song:
+            stages = [stage.strip() for stage in args.stages.split(",") if stage.strip()]
+            if not stages or set(stages) - set(RERUN_STAGES):
+                parser.error(f"--stages must be a comma-separated subset of: {', '.join(RERUN_STAGES)}")
+            try:
+                seed_state = load_song_state(args.from_song)
+            except (FileNotFoundError, ValueError) as song_err:
+                parser.error(str(song_err))
+                sys.exit(2)
+            try:
+                generate_song(
+                    seed_state["user_input"],
+                    args.local,
+                    seed_state["song_name"],
+                    args.persona or seed_state.get("persona_name"),
+                    seed_state=seed_state,
+                    stages=stages,
+                )
+            finally:
+                if cassette:
+                    cassette.save()
+            if "save" not in stages:
+                print("Note: 'save' was not selected, so no files were written.")
+            sys.exit(0)
 
-    if not prompt_text:
-        parser.error("You must provide a prompt as an argument or via --prompt-file")
-        sys.exit(2)
+        if (args.enqueue or args.worker) and args.queue == "memory":
+            # An in-process queue would vanish when --enqueue exits and starts empty for --worker.
+            parser.error('--queue memory is only usable programmatically; pass a SQLite path for --enqueue/--worker')
 
-    # Generate the song
-    generate_song(prompt_text, args.local, args.name, args.persona)
+        if args.enqueue:
+            prompt_files = sorted(glob.glob(os.path.expanduser(args.prompt_file))) if args.prompt_file else []
+            if args.prompt_file and not prompt_files:
+                parser.error(f"Prompt file not found: {args.prompt_file}")
+            prompts = [load_prompt_from_file(path) for path in prompt_files] or ([args.prompt] if args.prompt else [])
+            if not prompts:
+                parser.error("You must provide a prompt as an argument or via --prompt-file")
+            queue = open_queue(args.queue)
+            for text in prompts:
+                queue.enqueue(
+                    {
+                        "prompt": text,
+                        "name": args.name,
+                        "persona": args.persona,
+                        "local": args.local,
+                        "graph_mode": args.graph_mode,
+                    }
+                )
+            print(f"Enqueued {len(prompts)} job(s) in {args.queue}")
+            sys.exit(0)
+
+        prompt_text = None
+        if not args.worker:
+            # Load prompt from file or argument
+            try:
+                prompt_text = load_prompt_from_file(args.prompt_file) if args.prompt_file else args.prompt
+            except FileNotFoundError as prompt_err:
+                parser.error(str(prompt_err))
+                sys.exit(2)
+
+            if not prompt_text:
+                parser.error("You must provide a prompt as an argument or via --prompt-file")
+                sys.exit(2)
+
+        try:
+            if args.worker:
+                completed = run_workers(
+                    open_queue(args.queue),
+                    run_song_job,
+                    concurrency=args.concurrency,
+                    worker_id=args.worker_id,
+                    lease_seconds=float(os.getenv("QUEUE_LEASE_SECONDS", "600")),
+                    poll_interval=float(os.getenv("QUEUE_POLL_SECONDS", "5")),
+                    max_attempts=int(os.getenv("QUEUE_MAX_ATTEMPTS", "3")),
+                    exit_when_empty=args.exit_when_empty,
+                )
+                print(f"Worker finished {len(completed)} job(s)")
+            else:
+                # Generate the song
+                generate_song(prompt_text, args.local, args.name, args.persona, graph_mode=args.graph_mode)
+        finally:
+            if cassette:
+                cassette.save()
+    finally:
+        if profiler:
+            print(f"Profile written: {profiler.stop()}")
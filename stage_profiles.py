@@ -0,0 +1,190 @@
+import json
+import math
+import os
+import threading
+from collections import deque
+from contextlib import contextmanager
+from dataclasses import dataclass, replace
+from typing import Any, Deque, Dict, Optional, Tuple
+
+from prompt_sizing import count_tokens
+
+DEFAULT_STATS_PATH = os.path.join(".cache", "stage_output_tokens.json")
+
+
+@dataclass(frozen=True)
+class GenerationProfile:
+    """Per-stage generation settings; ``None`` fields fall back to LLM_MAX_TOKENS / LLM_TEMPERATURE."""
+    max_tokens: Optional[int] = None
+    temperature: Optional[float] = None
+    stop: Tuple[str, ...] = ()
+    json_mode: bool = False
+
+
+# Single place to tune stages. Free-form writing stages keep the global budget; small JSON stages
+# get tight caps so they don't reserve a full LLM_MAX_TOKENS slot on the server or run away.
+DEFAULT_STAGE_PROFILES: Dict[str, GenerationProfile] = {
+    "draft": GenerationProfile(),
+    "revise": GenerationProfile(),
+    "review": GenerationProfile(max_tokens=1500),
+    "critic": GenerationProfile(max_tokens=1500),
+    "preflight": GenerationProfile(max_tokens=1500),
+    "score": GenerationProfile(max_tokens=200, temperature=0.0, json_mode=True),
+    "triage": GenerationProfile(max_tokens=400, temperature=0.0, json_mode=True),
+    "metadata": GenerationProfile(max_tokens=600, json_mode=True),
+}
+
+_profiles: Optional[Dict[str, GenerationProfile]] = None
+_profiles_lock = threading.Lock()
+
+
+def base_stage(stage: str) -> str:
+    """Map stage variants to their profile name, e.g. ``review[2]`` -> ``review``."""
+    return stage.split("[", 1)[0]
+
+
+def load_stage_profiles() -> Dict[str, GenerationProfile]:
+    """Defaults merged with overrides from the JSON file at STAGE_PROFILES_FILE, if set.
+
+    The file maps stage names to any of max_tokens, temperature, stop (list) and json_mode.
+    """
+    global _profiles
+    with _profiles_lock:
+        if _profiles is not None:
+            return _profiles
+        profiles = dict(DEFAULT_STAGE_PROFILES)
+        path = os.getenv("STAGE_PROFILES_FILE")
+        if path:
+            with open(os.path.expanduser(path), "r") as file:
+                overrides = json.load(file)
+            for stage, values in overrides.items():
+                values = dict(values)
+                if "stop" in values:
+                    values["stop"] = tuple(values["stop"] or ())
+                profiles[stage] = replace(profiles.get(stage, GenerationProfile()), **values)
+        _profiles = profiles
+        return profiles
+
+
+@contextmanager
+def _file_lock(path: str):
+    """Exclusive lock on ``path`` shared by every process on the machine (fcntl, or msvcrt on Windows)."""
+    with open(path, "a+") as handle:
+        try:
+            import fcntl
+        except ImportError:
+            import msvcrt
+
+            handle.seek(0)
+            msvcrt.locking(handle.fileno(), msvcrt.LK_LOCK, 1)
+            try:
+                yield
+            finally:
+                handle.seek(0)
+                msvcrt.locking(handle.fileno(), msvcrt.LK_UNLCK, 1)
+        else:
+            fcntl.flock(handle, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(handle, fcntl.LOCK_UN)
+
+
+class OutputStats:
+    """Rolling per-stage output token counts, persisted so auto-tuning survives across runs."""
+
+    def __init__(self, path: str, window: int = 500):
+        self.path = path
+        self.window = window
+        self.lock = threading.Lock()
+        self.samples: Dict[str, Deque[int]] = self._read()
+
+    def _read(self) -> Dict[str, Deque[int]]:
+        if not os.path.isfile(self.path):
+            return {}
+        try:
+            with open(self.path, "r") as file:
+                return {stage: deque(values, maxlen=self.window) for stage, values in json.load(file).items()}
+        except (OSError, ValueError):
+            return {}
+
+    def record(self, stage: str, tokens: int) -> None:
+        """Add a sample to the file on disk, so processes sharing it merge rather than overwrite each other."""
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with self.lock, _file_lock(f"{self.path}.lock"):
+            samples = self._read()
+            samples.setdefault(stage, deque(maxlen=self.window)).append(tokens)
+            tmp_path = f"{self.path}.{os.getpid()}.tmp"
+            with open(tmp_path, "w") as file:
+                json.dump({name: list(values) for name, values in samples.items()}, file)
+            os.replace(tmp_path, self.path)
+            self.samples = samples
+
+    def percentile(self, stage: str, pct: float, min_samples: int) -> Optional[int]:
+        with self.lock:
+            values = sorted(self.samples.get(stage, ()))
+        if len(values) < max(1, min_samples):
+            return None
+        return values[min(len(values) - 1, int(math.ceil(pct / 100.0 * len(values))) - 1)]
+
+
+_stats: Optional[OutputStats] = None
+
+
+def output_stats() -> OutputStats:
+    global _stats
+    with _profiles_lock:
+        if _stats is None:
+            _stats = OutputStats(os.getenv("STAGE_STATS_FILE", DEFAULT_STATS_PATH))
+        return _stats
+
+
+def autotune_enabled() -> bool:
+    return os.getenv("STAGE_AUTOTUNE", "").strip().lower() in ("1", "true", "yes", "on")
+
+
+def stage_profile(stage: str) -> GenerationProfile:
+    """Resolve the profile for a stage, tightening max_tokens from observed p99 output when auto-tuning."""
+    name = base_stage(stage)
+    profile = load_stage_profiles().get(name, GenerationProfile())
+    if not autotune_enabled():
+        return profile
+    p99 = output_stats().percentile(name, 99.0, int(os.getenv("STAGE_AUTOTUNE_MIN_SAMPLES", "20")))
+    if p99 is None:
+        return profile
+    # Headroom above p99 so outputs that hit the cap push the next estimate up rather than staying truncated.
+    tuned = max(64, int(p99 * float(os.getenv("STAGE_AUTOTUNE_HEADROOM", "1.5"))))
+    if profile.max_tokens is not None:
+        tuned = min(tuned, profile.max_tokens)
+    return replace(profile, max_tokens=tuned)
+
+
+def batch_profile(stage: str, items: int) -> GenerationProfile:
+    """Profile for one combined request answering ``items`` prompts of ``stage`` as a JSON array.
+
+    The output cap scales with the item count; JSON object mode is off because the answer is an array.
+    """
+    profile = stage_profile(stage)
+    max_tokens = profile.max_tokens * items + 16 * items if profile.max_tokens else None
+    return replace(profile, max_tokens=max_tokens, json_mode=False)
+
+
+def record_stage_output(stage: str, output: str) -> None:
+    """Collect output sizes for auto-tuning; without STAGE_AUTOTUNE nothing reads them, so nothing is written."""
+    if autotune_enabled():
+        output_stats().record(base_stage(stage), count_tokens(output))
+
+
+def generation_params(profile: Optional[GenerationProfile], max_tokens: int, temperature: float) -> Dict[str, Any]:
+    """OpenAI-style sampling params for a call, applying the profile over the wrapper defaults."""
+    profile = profile or GenerationProfile()
+    params: Dict[str, Any] = {
+        # LLM_MAX_TOKENS stays the ceiling; profiles and auto-tuning only ever tighten it.
+        "max_tokens": min(profile.max_tokens, max_tokens) if profile.max_tokens else max_tokens,
+        "temperature": temperature if profile.temperature is None else profile.temperature,
+    }
+    if profile.stop:
+        params["stop"] = list(profile.stop)
+    return params
@@ -1,22 +1,54 @@
 import os
 import sys
 import base64
+import hashlib
+import shutil
+import tempfile
 from openai import OpenAI
 
+IMAGE_MODEL = "google/gemini-3-pro-image-preview"
+
 base_prompt = "You are an AI that generates album cover art based on textual descriptions in portrait aspect ratio. Create a visually striking and unique album cover art image based on the following description: "
 
-def generate_album_art_image(prompt: str, output_file: str) -> None:
+def image_cache_path(prompt: str) -> str:
+    """Return the cache location for an image keyed by model and full art prompt."""
+    cache_dir = os.environ.get("IMAGE_CACHE_DIR", os.path.join(".cache", "images"))
+    digest = hashlib.sha256(f"{IMAGE_MODEL}\n{base_prompt}{prompt}".encode("utf-8")).hexdigest()
+    return os.path.join(cache_dir, f"{digest}.jpg")
+
+
+def _write_atomically(output_file: str, write) -> None:
+    """Call ``write(tmp_path)`` then rename into place so readers never see a partial image."""
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(output_file) or ".", suffix=".tmp")
+    os.close(fd)
+    try:
+        write(tmp_path)
+        os.chmod(tmp_path, 0o644)
+        os.replace(tmp_path, output_file)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def generate_album_art_image(prompt: str, output_file: str, use_cache: bool = True) -> None:
     """
     Generate album cover art based on a textual prompt and save to a file.
 
     Args:
         prompt: The description for the album cover art.
         output_file: The path where the image will be saved.
+        use_cache: Reuse a previously generated image for the same model and prompt.
 
     Raises:
         ValueError: If OPENROUTER_API_KEY is missing.
         RuntimeError: If no image is returned from the API.
     """
+    cache_path = image_cache_path(prompt)
+    if use_cache and os.path.isfile(cache_path):
+        _write_atomically(output_file, lambda tmp_path: shutil.copyfile(cache_path, tmp_path))
+        return
+
     # Load API key from environment variable
     api_key = os.environ.get("OPENROUTER_API_KEY")
     if not api_key:
@@ -29,7 +61,7 @@ def generate_album_art_image(prompt: str, output_file: str) -> None:
 
     # Request image
     response = client.chat.completions.create(
-        model="google/gemini-3-pro-image-preview",
+        model=IMAGE_MODEL,
         messages=[{"role": "user", "content": base_prompt + prompt}],
         extra_body={"modalities": ["image", "text"]},
     )
@@ -44,8 +76,16 @@ def generate_album_art_image(prompt: str, output_file: str) -> None:
     base64_data = image_data_url.split(",", 1)[1]  # strip "data:image/jpeg;base64,"
 
     # Decode + write to file
-    with open(output_file, "wb") as f:
-        f.write(base64.b64decode(base64_data))
+    image = base64.b64decode(base64_data)
+
+    def _write(tmp_path: str) -> None:
+        with open(tmp_path, "wb") as f:
+            f.write(image)
+
+    _write_atomically(output_file, _write)
+
+    os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+    _write_atomically(cache_path, _write)
 
 def main():
     if len(sys.argv) < 3:
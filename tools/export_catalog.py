@@ -0,0 +1,168 @@
+import argparse
+import json
+import os
+import re
+import sys
+import time
+from datetime import datetime
+from typing import Any, Dict, Iterator, List, Optional
+
+from helpers import parse_song_markdown
+
+COLUMNS = [
+    "path",
+    "title",
+    "description",
+    "suno_styles",
+    "suno_exclude_styles",
+    "target_audience",
+    "commercial_potential",
+    "emotional_arc",
+    "technical_notes",
+    "user_prompt",
+    "lyrics",
+    "song_date",
+    "modified_at",
+]
+
+_DATE_PREFIX_RE = re.compile(r"^(\d{8})_")
+
+
+def iter_song_files(songs_dir: str, since: float = 0.0) -> Iterator[os.DirEntry]:
+    """Yield song markdown files modified after ``since`` without listing the whole directory up front.
+
+    Symlinks are the stable-name aliases of the latest run and are skipped so each run is exported once.
+    """
+    with os.scandir(songs_dir) as entries:
+        for entry in entries:
+            if entry.is_symlink():
+                continue
+            if entry.is_dir(follow_symlinks=False):
+                yield from iter_song_files(entry.path, since)
+            elif entry.name.endswith(".md") and entry.stat().st_mtime > since:
+                yield entry
+
+
+def song_record(entry: os.DirEntry) -> Dict[str, Any]:
+    with open(entry.path, "r") as file:
+        song = parse_song_markdown(file.read())
+    match = _DATE_PREFIX_RE.match(entry.name)
+    record = {column: song.get(column) for column in COLUMNS}
+    record["path"] = entry.path
+    record["song_date"] = datetime.strptime(match.group(1), "%Y%m%d").date().isoformat() if match else None
+    record["modified_at"] = datetime.fromtimestamp(entry.stat().st_mtime).isoformat(timespec="seconds")
+    return record
+
+
+def iter_chunks(records: Iterator[Dict[str, Any]], chunk_size: int) -> Iterator[List[Dict[str, Any]]]:
+    chunk: List[Dict[str, Any]] = []
+    for record in records:
+        chunk.append(record)
+        if len(chunk) >= chunk_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def _parquet_schema():
+    import pyarrow as pa
+
+    string_list = pa.list_(pa.string())
+    return pa.schema(
+        [(column, string_list if column in ("suno_styles", "suno_exclude_styles") else pa.string()) for column in COLUMNS]
+    )
+
+
+def write_jsonl(chunks: Iterator[List[Dict[str, Any]]], output: str, append: bool) -> int:
+    count = 0
+    with open(output, "a" if append else "w") as file:
+        for chunk in chunks:
+            file.write("".join(json.dumps(record, ensure_ascii=False) + "\n" for record in chunk))
+            count += len(chunk)
+    return count
+
+
+def write_parquet(chunks: Iterator[List[Dict[str, Any]]], output: str) -> int:
+    try:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+    except ImportError as exc:
+        raise RuntimeError("Parquet export requires pyarrow (pip install pyarrow)") from exc
+
+    schema = _parquet_schema()
+    count = 0
+    writer = None
+    tmp_path = f"{output}.{os.getpid()}.tmp"
+    try:
+        for chunk in chunks:
+            if writer is None:
+                writer = pq.ParquetWriter(tmp_path, schema)
+            writer.write_table(pa.Table.from_pylist(chunk, schema=schema))
+            count += len(chunk)
+    finally:
+        if writer is not None:
+            writer.close()
+    if writer is not None:
+        os.replace(tmp_path, output)
+    return count
+
+
+def export_catalog(songs_dir: str, output: str, fmt: str, chunk_size: int = 1000, incremental: bool = False) -> int:
+    """Stream every song under ``songs_dir`` into JSONL or Parquet, ``chunk_size`` records at a time.
+
+    With ``incremental`` only songs modified since the previous export (full or incremental) are
+    written: JSONL output is appended to, and Parquet output becomes a dataset directory receiving
+    one new part file per run. Without a recorded previous export, the JSONL file is rewritten in full.
+    Returns the number of exported songs.
+    """
+    state_path = f"{output.rstrip(os.sep)}.state.json"
+    if incremental and fmt == "parquet" and os.path.isfile(output):
+        raise RuntimeError(
+            f"{output} is a single Parquet file from a full export; incremental Parquet export writes a "
+            "dataset directory, so pass a directory path (e.g. catalog/) or re-run without --incremental"
+        )
+    since = None
+    if incremental and os.path.isfile(state_path):
+        with open(state_path, "r") as file:
+            since = float(json.load(file).get("last_export", 0.0))
+
+    started = time.time()
+    chunks = iter_chunks((song_record(entry) for entry in iter_song_files(songs_dir, since or 0.0)), chunk_size)
+    if fmt == "jsonl":
+        # Appending without a recorded export would duplicate every song already in the file.
+        count = write_jsonl(chunks, output, append=since is not None)
+    elif incremental:
+        os.makedirs(output, exist_ok=True)
+        count = write_parquet(chunks, os.path.join(output, f"part-{datetime.now().strftime('%Y%m%d%H%M%S')}.parquet"))
+    else:
+        count = write_parquet(chunks, output)
+
+    # Full exports record their time too, so a following --incremental run picks up from here.
+    with open(state_path, "w") as file:
+        json.dump({"last_export": started}, file)
+    return count
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(description="Export the song catalog to JSONL or Parquet")
+    parser.add_argument("output", help="Output file (or dataset directory for incremental Parquet)")
+    parser.add_argument("--songs-dir", default="songs", help="Directory containing song markdown files")
+    parser.add_argument("--format", choices=["jsonl", "parquet"], default=None, help="Defaults to the output extension")
+    parser.add_argument("--chunk-size", type=int, default=1000, help="Records held in memory per write")
+    parser.add_argument("--incremental", action="store_true", help="Only export songs modified since the last run")
+    args = parser.parse_args(argv)
+
+    fmt = args.format or ("jsonl" if args.output.endswith((".jsonl", ".json")) else "parquet")
+    if not os.path.isdir(args.songs_dir):
+        parser.error(f"Songs directory not found: {args.songs_dir}")
+    try:
+        count = export_catalog(args.songs_dir, args.output, fmt, chunk_size=args.chunk_size, incremental=args.incremental)
+    except RuntimeError as e:
+        print(f"Error exporting catalog: {e}")
+        sys.exit(1)
+    print(f"Exported {count} song(s) to {args.output}")
+
+
+if __name__ == "__main__":
+    main()